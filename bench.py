@@ -0,0 +1,470 @@
+'''Micro benchmarks, run them with:
+
+    $ python bench.py [name ...]
+'''
+import asyncio
+import datetime
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import tracemalloc
+import types
+
+from bson import ObjectId
+
+from codec import default_codec
+from router import Route, Router
+from server import App, HTTPRequest, HttpResponse, event_loop_policy
+
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    '''Register a benchmark by the function name'''
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+_loops = {}
+
+
+def get_loop(policy='asyncio'):
+    '''A loop of the policy, shared by the benchmarks'''
+    if policy not in _loops:
+        _loops[policy] = event_loop_policy(policy).new_event_loop()
+    return _loops[policy]
+
+
+def report(name, case, legacy, current):
+    '''Print the operations per second of both implementations'''
+    print(
+        '{:<10} {:<14} legacy {:>10.0f}/s  current {:>10.0f}/s  x{:.1f}'
+        .format(name, case, legacy, current, current / legacy)
+    )
+
+
+class LegacyHTTPRequest(HTTPRequest):
+    '''The 100 bytes read loop parser, kept to compare with'''
+    async def process(self):
+        self.header = {}
+        request_text = b''
+        while True:
+            request_text += await self.reader.read(100)
+            self.reader.feed_eof()
+            if self.reader.at_eof():
+                break
+
+        await self._process_lines(request_text)
+
+    async def _process_lines(self, request_text):
+        is_header = True
+        body = []
+        for line in request_text.split(b'\n'):
+            if is_header:
+                line = line.strip().replace(b'\r', b'')
+                if line:
+                    await self.parse_line(line)
+                else:
+                    is_header = False
+            else:
+                body.append(line)
+
+        await self._process_body(b'\n'.join(body))
+
+    async def _process_json_body(self, body):
+        if body:
+            data = json.loads(body.decode())
+            for key, value in data.items():
+                self.data[key] = value
+
+    async def parse_line(self, line):
+        header = self.header
+        if header == {}:
+            data = line.split(b' ')
+            header['METHOD'], header['PATH'], header['PROTOCOL'] = data
+            header['METHOD'] = header['METHOD'].decode()
+            header['PATH'] = header['PATH'].decode()
+            header['PROTOCOL'] = header['PROTOCOL'].decode()
+        else:
+            key, *value = line.split(b':')
+            header[key.decode()] = (b':'.join(value)).strip().decode()
+
+
+def http_request(method, path, body=b'', headers=None):
+    '''Build a raw HTTP request'''
+    lines = [
+        '{} {} HTTP/1.1'.format(method, path),
+        'Host: localhost:8888',
+        'User-Agent: bench',
+        'Accept: */*',
+    ]
+    for key, value in (headers or {}).items():
+        lines.append('{}: {}'.format(key, value))
+    if body:
+        lines.append('Content-Type: application/json')
+        lines.append('Content-Length: {}'.format(len(body)))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+def json_body(size):
+    '''A json object with about size bytes'''
+    phones = [{'number': '987654321', 'ddd': '21'}] * (size // 36)
+    return json.dumps({'name': 'João da Silva', 'phones': phones}).encode()
+
+
+async def _parse_many(request_class, raw, number):
+    for _ in range(number):
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        reader.feed_data(raw)
+        reader.feed_eof()
+        await request_class(reader).process()
+
+
+class NullWriter(object):
+    '''A StreamWriter that discards the data'''
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LegacyHttpResponse(HttpResponse):
+    '''The str based serialization, kept to compare with'''
+    def set_content(self, content):
+        if isinstance(content, dict) or isinstance(content, list):
+            self.set_header('Content-Type', 'application/json')
+            content = json.dumps(content)
+        self._content = content
+
+    def get_header(self):
+        self.header_defaults()
+        header = 'HTTP/1.1 {} {}'.format(
+            self.get_status_code(),
+            self.get_status_message()
+        )
+        for key, value in self._headers.items():
+            header += '\n{}: {}'.format(key, value)
+        return header
+
+    def header_defaults(self):
+        self._headers.setdefault('Server', 'Python Asyncio')
+        self._headers.setdefault('Content-Type', 'text/plain')
+        self._headers.setdefault(
+            'Date',
+            datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
+        )
+        self._headers.setdefault(
+            'Last-Modified',
+            datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
+        )
+
+    def get_response(self):
+        return '{}\n\n{}'.format(
+            self.get_header(),
+            self.get_content()
+        ).encode()
+
+    async def close(self):
+        self._writer.write(self.get_response())
+        await self._writer.drain()
+        self._writer.close()
+
+
+async def _respond_many(response_class, content, number):
+    writer = NullWriter()
+    for _ in range(number):
+        response = response_class(writer)
+        response.set_content(content)
+        await response.close()
+
+
+@benchmark
+def response(number=50000):
+    '''HttpResponse serialization against the str based one'''
+    loop = get_loop()
+    user = {
+        '_id': '56c5d4a8e13823125c5a2a9c',
+        'name': 'João da Silva',
+        'email': 'joao@silva.org',
+        'phones': [{'number': '987654321', 'ddd': '21'}],
+        'token': '0e3d4a2c-d6b9-11e5-a2a5-0242ac110002',
+    }
+    cases = [
+        ('text', '404'),
+        ('json user', user),
+    ]
+    for case, content in cases:
+        results = []
+        for response_class in (LegacyHttpResponse, HttpResponse):
+            started = time.perf_counter()
+            loop.run_until_complete(
+                _respond_many(response_class, content, number)
+            )
+            results.append(number / (time.perf_counter() - started))
+        report('response', case, *results)
+
+
+@benchmark
+def routing(number=100000):
+    '''Router.match against routes.Mapper, when it is installed'''
+    try:
+        from routes import Mapper
+    except ImportError:
+        print('routing: install Routes to compare with routes.Mapper')
+        return
+
+    urls = ['/login/', '/user/', '/user/{id}/']
+    mapper = Mapper()
+    router = Router()
+    for url in urls:
+        mapper.connect(None, url, _fn=None)
+        router.add(Route(url, None))
+
+    cases = [
+        ('static', ['/login/', '/user/']),
+        ('dynamic', ['/user/56c5d4a8e13823125c5a2a9c/']),
+        ('dynamic 10k', [
+            '/user/{:024x}/'.format(i) for i in range(10000)
+        ]),
+        ('not found', ['/users/', '/user/1/2/']),
+    ]
+    for case, paths in cases:
+        results = []
+        for match in (mapper.match, router.match):
+            started = time.perf_counter()
+            for i in range(number):
+                match(paths[i % len(paths)])
+            results.append(number / (time.perf_counter() - started))
+        report('routing', case, *results)
+
+
+@benchmark
+def parser(number=2000):
+    '''HTTPRequest.process against the 100 bytes read loop'''
+    loop = get_loop()
+    cases = [
+        ('GET', http_request('GET', '/user/1/', headers={'token': 'x'})),
+        ('POST 1KB', http_request('POST', '/user/', json_body(1024))),
+        ('POST 64KB', http_request('POST', '/user/', json_body(65536))),
+    ]
+    for case, raw in cases:
+        results = []
+        for request_class in (LegacyHTTPRequest, HTTPRequest):
+            # Big bodies are slow on the legacy parser
+            n = max(number * 1024 // len(raw), 10)
+            started = time.perf_counter()
+            loop.run_until_complete(_parse_many(request_class, raw, n))
+            results.append(n / (time.perf_counter() - started))
+        report('parser', case, *results)
+
+
+def _legacy_loads(data):
+    return dict(json.loads(data.decode()))
+
+
+def _legacy_dumps(user):
+    user = dict(user)
+    user['_id'] = str(user['_id'])
+    user['created'] = str(user['created'])
+    return json.dumps(user).encode()
+
+
+@benchmark
+def codec(number=20000):
+    '''The json module on str against the default codec on bytes'''
+    user = {
+        '_id': ObjectId(),
+        'name': 'João da Silva',
+        'email': 'joao@silva.org',
+        'phones': [{'number': '987654321', 'ddd': '21'}],
+        'created': datetime.datetime.now(),
+    }
+    cases = [
+        ('decode 1KB', json_body(1024), _legacy_loads, default_codec.loads),
+        ('decode 64KB', json_body(65536), _legacy_loads,
+         default_codec.loads),
+        ('encode user', user, _legacy_dumps, default_codec.dumps),
+    ]
+    for case, value, legacy, current in cases:
+        n = max(number * 1024 // len(str(value)), 10)
+        results = []
+        for fn in (legacy, current):
+            started = time.perf_counter()
+            for _ in range(n):
+                fn(value)
+            results.append(n / (time.perf_counter() - started))
+        report('codec', case, *results)
+    print('codec: default codec is {}'.format(default_codec.name))
+
+
+class Ready(object):
+    '''An awaitable that completes without suspending'''
+    def __await__(self):
+        return
+        yield
+
+
+@types.coroutine
+def _generator_chain(depth, leaf):
+    if depth:
+        result = yield from _generator_chain(depth - 1, leaf)
+        return result
+    result = yield from leaf().__await__()
+    return result
+
+
+async def _native_chain(depth, leaf):
+    if depth:
+        return await _native_chain(depth - 1, leaf)
+    return await leaf()
+
+
+@types.coroutine
+def _generator_many(number, depth, leaf):
+    for _ in range(number):
+        yield from _generator_chain(depth, leaf)
+
+
+async def _native_many(number, depth, leaf):
+    for _ in range(number):
+        await _native_chain(depth, leaf)
+
+
+def _sleep():
+    return asyncio.sleep(0)
+
+
+@benchmark
+def coroutines(number=100000):
+    '''Generator based coroutines, like @asyncio.coroutine, against native
+    ones. The depth 6 is the one of a request: handle, dispatch, view
+    handle, get, get_user and the cache. The suspend case goes through
+    the loop at the end of the chain'''
+    loop = get_loop()
+    cases = [
+        ('depth 1', 1, Ready),
+        ('depth 6', 6, Ready),
+        ('suspend 6', 6, _sleep),
+    ]
+    for case, depth, leaf in cases:
+        results = []
+        for many in (_generator_many, _native_many):
+            started = time.perf_counter()
+            loop.run_until_complete(many(number, depth, leaf))
+            results.append(number / (time.perf_counter() - started))
+        report('coroutines', case, *results)
+
+
+async def _round_trips(app, number):
+    '''Requests on a keep-alive connection to the app, one at a time'''
+    server = await app.create_server('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = http_request('GET', '/')
+    started = time.perf_counter()
+    for _ in range(number):
+        writer.write(request)
+        await reader.readuntil(b'\r\n\r\n')
+        await reader.readexactly(2)
+    elapsed = time.perf_counter() - started
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return number / elapsed
+
+
+@benchmark
+def loops(number=10000):
+    '''Request round trips on the asyncio loop against uvloop'''
+    try:
+        get_loop('uvloop')
+    except ValueError:
+        print('loops: install uvloop to compare with the asyncio loop')
+        return
+
+    app = App(max_keep_alive_requests=number + 1)
+
+    @app.route('/', methods=('GET',))
+    async def index(request, response):
+        response.set_content('ok')
+
+    results = [
+        get_loop(policy).run_until_complete(_round_trips(app, number))
+        for policy in ('asyncio', 'uvloop')
+    ]
+    report('loops', 'round trip', *results)
+
+
+def _hold_connections(port, number):
+    '''Open number idle connections to port in a child process, so they
+    are not counted in the memory of the server'''
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        sockets = [
+            socket.create_connection(('127.0.0.1', port))
+            for _ in range(number)
+        ]
+        while sockets:
+            signal.pause()
+    finally:
+        os._exit(0)
+
+
+async def _idle_footprint(app, number):
+    '''Memory allocated by the server for number idle connections'''
+    server = await app.create_server('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    pid = _hold_connections(port, number)
+    try:
+        while len(app._connections) < number:
+            await asyncio.sleep(0.1)
+        # Every handler is waiting for its first request
+        await asyncio.sleep(0.5)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    tracemalloc.stop()
+    await app.close_connections()
+    server.close()
+    await server.wait_closed()
+    return snapshot.compare_to(before, 'filename')
+
+
+@benchmark
+def connections(number=10000):
+    '''Memory per idle connection, waiting for the first request'''
+    app = App(header_timeout=600)
+    stats = get_loop().run_until_complete(_idle_footprint(app, number))
+    total = sum(stat.size_diff for stat in stats)
+    print('connections {} idle: {:.1f} MiB, {:.0f} bytes each'.format(
+        number, total / 2 ** 20, total / number
+    ))
+    for stat in stats[:5]:
+        print('    {:>8.0f} bytes  {}'.format(
+            stat.size_diff / number, stat.traceback[0].filename
+        ))
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
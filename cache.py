@@ -0,0 +1,98 @@
+import asyncio
+from collections import OrderedDict
+
+from expiry import ExpiryHeap
+
+
+class AsyncCache(object):
+    '''An in-process cache of values loaded by coroutines.
+
+    Entries expire ttl seconds after they are stored and the least recently
+    used ones are evicted when there are more than size. Concurrent misses
+    of the same key wait for a single load.
+    '''
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._expiry = ExpiryHeap(self._expire)
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def peek(self, key):
+        '''Return the cached value of key or None'''
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    async def get(self, key, loader):
+        '''Return the value of key, calling the loader coroutine on a miss.
+
+        None results are not cached.
+        '''
+        value = self.peek(key)
+        if value is not None:
+            self.stats['hits'] += 1
+            return value
+
+        future = self._loading.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            value = await asyncio.shield(future)
+            return value
+
+        self.stats['misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await loader()
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieve it, the waiters may be gone
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            if not future.done():
+                future.cancel()
+            # An invalidation while loading makes the value stale
+            is_current = self._loading.get(key) is future
+            if is_current:
+                del self._loading[key]
+
+        if is_current and value is not None:
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        '''Store the value of key'''
+        self._loading.pop(key, None)
+        entries = self._entries
+        entries[key] = value
+        entries.move_to_end(key)
+        self._expiry.schedule(key, self.ttl)
+        while len(entries) > self.size:
+            evicted, _ = entries.popitem(last=False)
+            self._expiry.cancel(evicted)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        '''Forget the value of key'''
+        self._loading.pop(key, None)
+        self._entries.pop(key, None)
+        self._expiry.cancel(key)
+
+    def _expire(self, key):
+        self._entries.pop(key, None)
+        self.stats['expirations'] += 1
@@ -0,0 +1,154 @@
+import asyncio
+
+from cache import AsyncCache
+
+
+def test_coalesced_misses():
+    async def run():
+        cache = AsyncCache()
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        values = await asyncio.gather(*(
+            cache.get('key', loader) for _ in range(5)
+        ))
+        return cache, loads, values
+
+    cache, loads, values = asyncio.run(run())
+
+    # One load for the concurrent misses
+    assert values == ['value'] * 5
+    assert len(loads) == 1
+    assert cache.stats['misses'] == 1
+    assert cache.stats['coalesced'] == 4
+    assert cache.peek('key') == 'value'
+
+
+def test_loader_error():
+    async def run():
+        cache = AsyncCache()
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise ValueError('load failed')
+
+        results = await asyncio.gather(
+            cache.get('key', loader), cache.get('key', loader),
+            return_exceptions=True
+        )
+        return cache, results
+
+    cache, results = asyncio.run(run())
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(cache) == 0
+
+
+def test_none_not_cached():
+    async def loader():
+        return None
+
+    async def run():
+        cache = AsyncCache()
+        await cache.get('key', loader)
+        return cache
+
+    cache = asyncio.run(run())
+
+    assert len(cache) == 0
+
+
+def test_invalidate_while_loading():
+    async def run():
+        cache = AsyncCache()
+        started = asyncio.Event()
+
+        async def loader():
+            started.set()
+            await asyncio.sleep(0.01)
+            return 'stale'
+
+        loading = asyncio.ensure_future(cache.get('key', loader))
+        await started.wait()
+        cache.invalidate('key')
+        value = await loading
+        return cache, value
+
+    cache, value = asyncio.run(run())
+
+    # The caller gets the value loaded, it is not cached
+    assert value == 'stale'
+    assert cache.peek('key') is None
+
+
+def test_set_while_loading():
+    async def run():
+        cache = AsyncCache()
+        started = asyncio.Event()
+
+        async def loader():
+            started.set()
+            await asyncio.sleep(0.01)
+            return 'old'
+
+        loading = asyncio.ensure_future(cache.get('key', loader))
+        await started.wait()
+        cache.set('key', 'new')
+        await loading
+        return cache
+
+    cache = asyncio.run(run())
+
+    # The value set after the load started is kept
+    assert cache.peek('key') == 'new'
+
+
+def test_lru_eviction():
+    async def run():
+        cache = AsyncCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # "a" is used, "b" becomes the least recently used
+        assert cache.peek('a') == 1
+        cache.set('c', 3)
+        return cache
+
+    cache = asyncio.run(run())
+
+    assert cache.peek('b') is None
+    assert cache.peek('a') == 1
+    assert cache.peek('c') == 3
+    assert len(cache) == 2
+    assert cache.stats['evictions'] == 1
+
+
+def test_ttl_expiry():
+    async def run():
+        cache = AsyncCache(ttl=0.05)
+        cache.set('key', 'value')
+        assert cache.peek('key') == 'value'
+        await asyncio.sleep(0.1)
+        return cache
+
+    cache = asyncio.run(run())
+
+    assert cache.peek('key') is None
+    assert cache.stats['expirations'] == 1
+
+
+def test_set_renews_ttl():
+    async def run():
+        cache = AsyncCache(ttl=0.1)
+        cache.set('key', 'old')
+        await asyncio.sleep(0.06)
+        cache.set('key', 'new')
+        await asyncio.sleep(0.06)
+        return cache
+
+    cache = asyncio.run(run())
+
+    assert cache.peek('key') == 'new'
@@ -0,0 +1,88 @@
+'''JSON codecs that decode from bytes and encode to bytes.
+
+orjson is used when installed, then ujson, then the json module. Each
+codec encodes ObjectId as its string and datetime in ISO 8601.
+'''
+import datetime
+import json
+
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(value):
+    '''Encode the types json does not know'''
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+class JsonCodec(object):
+    '''The json module codec'''
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, value):
+        return json.dumps(
+            value, default=_default, separators=(',', ':')
+        ).encode()
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+    def dumps(self, value):
+        return ujson.dumps(value, default=_default).encode()
+
+
+class OrjsonCodec(JsonCodec):
+    '''orjson encodes datetime itself and returns bytes'''
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, value):
+        return orjson.dumps(value, default=_default)
+
+
+CODECS = {
+    'orjson': (OrjsonCodec, orjson),
+    'ujson': (UjsonCodec, ujson),
+    'json': (JsonCodec, json),
+}
+
+
+def get_codec(name=None):
+    '''The codec called name, or the fastest installed one'''
+    if name is None:
+        for name in ('orjson', 'ujson', 'json'):
+            codec_class, module = CODECS[name]
+            if module is not None:
+                return codec_class()
+
+    if name not in CODECS:
+        raise ValueError('Unknown JSON codec: {}'.format(name))
+    codec_class, module = CODECS[name]
+    if module is None:
+        raise ValueError('The {} module is not installed'.format(name))
+    return codec_class()
+
+
+default_codec = get_codec()
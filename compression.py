@@ -0,0 +1,120 @@
+import asyncio
+import zlib
+
+# Prefixes of the content types worth compressing
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript',
+    'application/xml', 'image/svg+xml',
+)
+
+# zlib window bits of each content coding, HTTP deflate is the zlib format
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class DecompressionLimit(Exception):
+    '''The decompressed data is larger than allowed'''
+
+
+def compress(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding, max_size):
+    '''Decompress data without producing more than max_size bytes, raise
+    ValueError when it is invalid'''
+    decompressor = zlib.decompressobj(WBITS[encoding])
+    try:
+        result = decompressor.decompress(data, max_size + 1)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if len(result) > max_size:
+        raise DecompressionLimit()
+    if not decompressor.eof:
+        raise ValueError('Incomplete {} data'.format(encoding))
+    return result
+
+
+async def decompress_stream(chunks, encoding, chunk_size=65536):
+    '''Decompress an async iterable of chunks into pieces of at most
+    chunk_size bytes, raise ValueError when it is invalid'''
+    decompressor = zlib.decompressobj(WBITS[encoding])
+    try:
+        async for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk, chunk_size)
+                chunk = decompressor.unconsumed_tail
+                if data:
+                    yield data
+        data = decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise ValueError('Incomplete {} data'.format(encoding))
+
+
+def parse_accept_encoding(value):
+    '''The q values of the codings of an Accept-Encoding header'''
+    codings = {}
+    for item in value.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[coding] = q
+    return codings
+
+
+class Compression(object):
+    '''Response compression settings.
+
+    Bodies of compressible types and at least min_size bytes are
+    compressed with the coding the client prefers, the ones of
+    executor_min_size bytes or more in the default executor.
+    '''
+    def __init__(self, min_size=1024, level=6, executor_min_size=131072,
+                 types=COMPRESSIBLE_TYPES, encodings=('gzip', 'deflate')):
+        self.min_size = min_size
+        self.level = level
+        self.executor_min_size = executor_min_size
+        self.types = types
+        self.encodings = encodings
+
+    def negotiate(self, accept_encoding):
+        '''The coding to use for an Accept-Encoding header, None for the
+        identity'''
+        if not accept_encoding:
+            return None
+        codings = parse_accept_encoding(accept_encoding)
+        default = codings.get('*', 0.0)
+        best, best_q = None, 0.0
+        for encoding in self.encodings:
+            q = codings.get(encoding, default)
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def compressible(self, content_type):
+        return content_type.lower().startswith(self.types)
+
+    async def compress(self, data, encoding):
+        if len(data) < self.executor_min_size:
+            return compress(data, encoding, self.level)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            None, compress, data, encoding, self.level
+        )
+        return result
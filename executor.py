@@ -0,0 +1,84 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class ExecutorBusy(Exception):
+    '''Raised when there are more queued calls than the executor accepts'''
+
+
+def _timed_call(fn, *args):
+    '''Run fn inside the worker and return the elapsed time with the result'''
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+class BoundedExecutor(object):
+    '''Run blocking functions out of the event loop in a worker pool.
+
+    At most `workers` calls run at the same time and at most `queue_size`
+    calls wait for a free worker, any call above it raises ExecutorBusy.
+    '''
+    kinds = {
+        'process': ProcessPoolExecutor,
+        'thread': ThreadPoolExecutor,
+    }
+
+    def __init__(self, kind='process', workers=None, queue_size=64):
+        if kind not in self.kinds:
+            raise ValueError('Unknown executor kind: {}'.format(kind))
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self._executor = None
+        self._semaphore = None
+        self._pending = 0
+        self.stats = {
+            'calls': 0,
+            'rejected': 0,
+            'queue_wait': 0.0,
+            'run_time': 0.0,
+        }
+
+    def get_executor(self):
+        '''Create the pool on first use, after the event loop is running'''
+        if self._executor is None:
+            self._executor = self.kinds[self.kind](self.workers)
+            self._semaphore = asyncio.Semaphore(self.workers)
+        return self._executor
+
+    @property
+    def pending(self):
+        '''Number of calls running or waiting for a worker'''
+        return self._pending
+
+    async def run(self, fn, *args, reject=True):
+        '''Run fn(*args) in the pool and return its result, without reject
+        the call waits for a worker even when the queue is full'''
+        executor = self.get_executor()
+        if reject and self._pending >= self.workers + self.queue_size:
+            self.stats['rejected'] += 1
+            raise ExecutorBusy()
+
+        self._pending += 1
+        queued_at = time.perf_counter()
+        try:
+            async with self._semaphore:
+                self.stats['queue_wait'] += time.perf_counter() - queued_at
+                loop = asyncio.get_running_loop()
+                elapsed, result = await loop.run_in_executor(
+                    executor, _timed_call, fn, *args
+                )
+            self.stats['calls'] += 1
+            self.stats['run_time'] += elapsed
+            return result
+        finally:
+            self._pending -= 1
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+            self._semaphore = None
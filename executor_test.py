@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+import settings
+from executor import BoundedExecutor, ExecutorBusy
+from server import HttpResponse
+from users import busy_response
+
+
+def test_reject_when_full():
+    async def run():
+        executor = BoundedExecutor('thread', workers=1, queue_size=0)
+        running = asyncio.ensure_future(executor.run(time.sleep, 0.05))
+        await asyncio.sleep(0)
+        assert executor.pending == 1
+        with pytest.raises(ExecutorBusy):
+            await executor.run(time.sleep, 0)
+        await running
+        executor.shutdown()
+        return executor
+
+    executor = asyncio.run(run())
+
+    assert executor.pending == 0
+    assert executor.stats['calls'] == 1
+    assert executor.stats['rejected'] == 1
+    assert executor.stats['run_time'] >= 0.05
+    assert executor.stats['queue_wait'] < 0.05
+
+
+def test_wait_without_reject():
+    async def run():
+        executor = BoundedExecutor('thread', workers=1, queue_size=0)
+        results = await asyncio.gather(
+            executor.run(time.sleep, 0.05),
+            executor.run(time.sleep, 0.05, reject=False)
+        )
+        executor.shutdown()
+        return executor, results
+
+    executor, results = asyncio.run(run())
+
+    # The second call waited for the worker instead of failing
+    assert results == [None, None]
+    assert executor.stats['calls'] == 2
+    assert executor.stats['rejected'] == 0
+    assert executor.stats['queue_wait'] >= 0.05
+    assert executor.stats['run_time'] >= 0.1
+
+
+def test_busy_response(monkeypatch):
+    monkeypatch.setattr(settings, 'retry_after', 7)
+    response = HttpResponse(None)
+    busy_response(response)
+
+    assert response.status_code == 503
+    assert response._headers['Retry-After'] == '7'
@@ -0,0 +1,76 @@
+import asyncio
+import heapq
+import itertools
+
+
+class ExpiryHeap(object):
+    '''Call on_expire(key) when the deadline of a key is reached.
+
+    The deadlines are kept in a heap and a single loop.call_at timer is
+    armed for the nearest one, so nothing runs while nothing expires.
+    Deadlines are in loop.time() seconds.
+    '''
+    def __init__(self, on_expire, loop=None):
+        self.on_expire = on_expire
+        self._loop = loop
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def schedule(self, key, delay):
+        '''Expire key in delay seconds, replacing its previous deadline'''
+        deadline = self.loop.time() + delay
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+        if self._timer_deadline is None or deadline < self._timer_deadline:
+            self._arm(deadline)
+
+    def cancel(self, key):
+        '''Forget the deadline of key, its heap entry is dropped later'''
+        self._deadlines.pop(key, None)
+
+    def _compact(self):
+        '''Drop the entries of cancelled or rescheduled keys'''
+        deadlines = self._deadlines
+        self._heap = [
+            entry for entry in self._heap
+            if deadlines.get(entry[2]) == entry[0]
+        ]
+        heapq.heapify(self._heap)
+
+    def _arm(self, deadline):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self.loop.call_at(deadline, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        self._timer_deadline = None
+        heap = self._heap
+        deadlines = self._deadlines
+        now = self.loop.time()
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            if deadlines.get(key) == deadline:
+                del deadlines[key]
+                self.on_expire(key)
+
+        # Skip the entries of cancelled keys before arming the next timer
+        while heap and deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        if heap:
+            self._arm(heap[0][0])
@@ -0,0 +1,333 @@
+'''Load test of the application routes, run it with:
+
+    $ python loadtest.py --concurrency 50 --duration 10 --output results.json
+
+By default the application runs in this process using memdb instead of
+MongoDB. Use --url to test a running server, its TOKEN_LIFETIME must be
+longer than --duration. Use --compare to check the results against a
+previous run.
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+import settings
+from server import cancel_tasks, event_loop_policy
+
+
+class Client(object):
+    '''A persistent HTTP/1.1 connection'''
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, data=None, headers=None):
+        '''Send a request and return the status code and the json body'''
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+        body = json.dumps(data).encode() if data is not None else b''
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: loadtest']
+        for key, value in (headers or {}).items():
+            lines.append('{}: {}'.format(key, value))
+        if body:
+            lines.append('Content-Type: application/json')
+            lines.append('Content-Length: {}'.format(len(body)))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+
+        try:
+            status, headers, body = await self._read_response()
+        except Exception:
+            self.close()
+            raise
+        if headers.get('connection') == 'close':
+            self.close()
+        return status, json.loads(body.decode()) if body else None
+
+    async def _read_response(self):
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            body = await self.reader.readexactly(length)
+        elif headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self.reader.read()
+        return status, headers, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+_emails = itertools.count()
+
+
+def new_user():
+    return {
+        'name': 'João da Silva',
+        'email': 'loadtest{}-{}@silva.org'.format(
+            int(time.time()), next(_emails)
+        ),
+        'password': 'hunter2',
+        'phones': [{'number': '987654321', 'ddd': '21'}],
+    }
+
+
+def login(user):
+    return 'POST', '/login/', {
+        'email': user['email'],
+        'password': user['password'],
+    }, None
+
+
+def create(user):
+    return 'POST', '/user/', new_user(), None
+
+
+def profile(user):
+    path = '/user/{}/'.format(user['_id'])
+    return 'GET', path, None, {'token': user['token']}
+
+
+def update(user):
+    path = '/user/{}/'.format(user['_id'])
+    return 'PUT', path, {'name': 'José da Silva'}, {'token': user['token']}
+
+
+# Scenarios by name, login runs last because it replaces the tokens
+SCENARIOS = OrderedDict([
+    ('create', create),
+    ('get', profile),
+    ('put', update),
+    ('login', login),
+])
+
+
+def percentile(values, percent):
+    '''Nearest rank percentile of sorted values'''
+    if not values:
+        return 0
+    index = int(math.ceil(percent / 100 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+async def create_users(clients):
+    '''Create a user for each client'''
+    users = []
+    for client in clients:
+        user = new_user()
+        status, created = await client.request('POST', '/user/', user)
+        if status != 201:
+            raise Exception('Can not create users: {} {}'.format(
+                status, created
+            ))
+        user['_id'] = created['_id']
+        user['token'] = created['token']
+        users.append(user)
+    return users
+
+
+async def refresh_tokens(clients, users):
+    '''Login again, so the tokens do not expire during the scenario'''
+    for client, user in zip(clients, users):
+        status, logged = await client.request(*login(user)[:3])
+        user['token'] = logged['token']
+
+
+async def run_scenario(scenario, clients, users, duration):
+    '''Send requests from every client until duration seconds pass'''
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    async def worker(client, user):
+        while time.perf_counter() < deadline:
+            method, path, data, headers = scenario(user)
+            started = time.perf_counter()
+            try:
+                status, _ = await client.request(
+                    method, path, data, headers
+                )
+            except Exception:
+                status = None
+            latencies.append(time.perf_counter() - started)
+            if status is None or status >= 400:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        worker(client, user) for client, user in zip(clients, users)
+    ])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return OrderedDict([
+        ('requests', len(latencies)),
+        ('errors', errors[0]),
+        ('throughput', len(latencies) / elapsed),
+        ('latency_ms', OrderedDict(
+            (name, percentile(latencies, percent) * 1000)
+            for name, percent in (
+                ('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)
+            )
+        )),
+    ])
+
+
+async def load_test(host, port, names, concurrency, duration):
+    clients = [Client(host, port) for _ in range(concurrency)]
+    users = await create_users(clients)
+    results = OrderedDict()
+    try:
+        for name in names:
+            if name in ('get', 'put'):
+                await refresh_tokens(clients, users)
+            results[name] = await run_scenario(
+                SCENARIOS[name], clients, users, duration
+            )
+            print_result(name, results[name])
+    finally:
+        for client in clients:
+            client.close()
+    return results
+
+
+def print_result(name, result):
+    latency = result['latency_ms']
+    print(
+        '{:<8} {:>8} requests {:>6} errors {:>9.1f} req/s  '
+        'p50 {:>7.2f}ms  p95 {:>7.2f}ms  p99 {:>7.2f}ms'.format(
+            name, result['requests'], result['errors'],
+            result['throughput'], latency['p50'], latency['p95'],
+            latency['p99']
+        )
+    )
+
+
+def compare(results, previous, tolerance):
+    '''Print the change against previous results, return False when the
+    throughput of a route dropped more than tolerance'''
+    passed = True
+    for name, result in results['routes'].items():
+        before = previous['routes'].get(name)
+        if not before:
+            continue
+        ratio = result['throughput'] / before['throughput']
+        p99 = result['latency_ms']['p99'] / before['latency_ms']['p99']
+        regression = ratio < 1 - tolerance
+        passed = passed and not regression
+        print('{:<8} throughput x{:.2f}  p99 x{:.2f}{}'.format(
+            name, ratio, p99, '  REGRESSION' if regression else ''
+        ))
+    return passed
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Load test the routes')
+    parser.add_argument('--url', help='host:port of a running server')
+    parser.add_argument('--routes', default=','.join(SCENARIOS),
+                        help='comma separated: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds each route is tested')
+    parser.add_argument('--db-latency', type=float, default=0,
+                        help='seconds each memdb operation takes')
+    parser.add_argument('--output', help='save the results as json')
+    parser.add_argument('--compare', help='json results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='throughput drop that fails --compare')
+    return parser.parse_args(args)
+
+
+async def run(options, names):
+    '''Test the server of --url or the application in this process'''
+    app = server = None
+    if options.url:
+        host, port = options.url.rsplit(':', 1)
+    else:
+        import memdb
+        settings.db.use(memdb.Database(options.db_latency))
+        settings.token_lifetime = max(
+            settings.token_lifetime, int(options.duration) * 2 + 60
+        )
+        # Every client has the same address
+        settings.login_rate = settings.signup_rate = 0
+        from users import app
+        import utils
+        await utils.create_indexes()
+        server = await app.create_server('127.0.0.1', 0)
+        host, port = server.sockets[0].getsockname()[:2]
+
+    try:
+        return await load_test(
+            host, int(port), names, options.concurrency, options.duration
+        )
+    finally:
+        if server is not None:
+            server.close()
+            await app.close_connections()
+            await server.wait_closed()
+
+
+def main(args):
+    options = parse_args(args)
+    names = options.routes.split(',')
+    for name in names:
+        if name not in SCENARIOS:
+            raise SystemExit('Unknown route: {}'.format(name))
+
+    loop = event_loop_policy(settings.event_loop).new_event_loop()
+    try:
+        routes = loop.run_until_complete(run(options, names))
+    finally:
+        cancel_tasks(loop)
+        loop.close()
+
+    results = OrderedDict([
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('event_loop', type(loop).__module__),
+        ('server', options.url or 'in-process memdb'),
+        ('token_mode', settings.token_mode),
+        ('concurrency', options.concurrency),
+        ('duration', options.duration),
+        ('routes', routes),
+    ])
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if options.compare:
+        with open(options.compare) as previous:
+            if not compare(results, json.load(previous), options.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,259 @@
+'''An in-memory stand-in for the Motor database used by the benchmarks.
+
+It implements the part of the collection API used by the application.
+Methods return futures, like Motor, so they work with "await" and when
+nobody waits for them.
+'''
+import asyncio
+import copy
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import (
+    BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult,
+    UpdateResult
+)
+
+
+def _compare(value, condition):
+    '''Match a value against a query condition'''
+    if isinstance(condition, dict):
+        for operator, operand in condition.items():
+            if operator == '$in':
+                if value not in operand:
+                    return False
+            elif value is None:
+                return False
+            elif operator == '$gt' and not value > operand:
+                return False
+            elif operator == '$gte' and not value >= operand:
+                return False
+            elif operator == '$lt' and not value < operand:
+                return False
+            elif operator == '$lte' and not value <= operand:
+                return False
+        return True
+    return value == condition
+
+
+def project(document, projection):
+    '''Copy the document without the fields of an exclusion projection'''
+    document = copy.deepcopy(document)
+    for key, value in (projection or {}).items():
+        if not value:
+            document.pop(key, None)
+    return document
+
+
+def match(document, query):
+    '''Check if the document matches a query'''
+    for key, condition in (query or {}).items():
+        if not _compare(document.get(key), condition):
+            return False
+    return True
+
+
+class Cursor(object):
+    '''The documents of a find, iterated with "async for"'''
+    def __init__(self, collection, documents, projection):
+        self.collection = collection
+        self._documents = documents
+        self._projection = projection
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self._documents.sort(key=lambda document: document.get(key))
+        if direction < 0:
+            self._documents.reverse()
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        documents = self._documents
+        if self._limit:
+            documents = documents[:self._limit]
+        # A batch from the server
+        await self.collection._result(None)
+        for document in documents:
+            yield project(document, self._projection)
+
+    async def to_list(self, length=None):
+        return [document async for document in self]
+
+
+class Collection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._documents = {}
+        # Values of the unique fields, by field name
+        self._unique = {}
+
+    def _result(self, result, error=None):
+        '''A future with the result, or the error, after the simulated
+        latency'''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if error is not None:
+            callback, result = future.set_exception, error
+        else:
+            callback = future.set_result
+        latency = self.database.latency
+        if latency:
+            loop.call_later(latency, callback, result)
+        else:
+            callback(result)
+        self.database.operations += 1
+        return future
+
+    def _find(self, query):
+        if query and set(query) == {'_id'} and \
+                not isinstance(query['_id'], dict):
+            document = self._documents.get(query['_id'])
+            return [document] if document is not None else []
+        return [
+            document for document in self._documents.values()
+            if match(document, query)
+        ]
+
+    def find_one(self, query=None, projection=None):
+        documents = self._find(query)
+        document = project(documents[0], projection) if documents else None
+        return self._result(document)
+
+    def find(self, query=None, projection=None):
+        return Cursor(self, self._find(query), projection)
+
+    def count_documents(self, query):
+        return self._result(len(self._find(query)))
+
+    def _duplicate(self, document):
+        '''The name of the unique field of document already stored'''
+        if document['_id'] in self._documents:
+            return '_id'
+        for key, values in self._unique.items():
+            if document.get(key) in values:
+                return key
+
+    def _index(self, document, add=True):
+        for key, values in self._unique.items():
+            if add:
+                values.add(document.get(key))
+            else:
+                values.discard(document.get(key))
+
+    def insert_one(self, document):
+        document.setdefault('_id', ObjectId())
+        key = self._duplicate(document)
+        if key is not None:
+            return self._result(None, DuplicateKeyError(
+                'E11000 duplicate key error collection: {} index: {}'.format(
+                    self.name, key
+                ), 11000
+            ))
+        self._index(document)
+        self._documents[document['_id']] = copy.deepcopy(document)
+        return self._result(InsertOneResult(document['_id'], True))
+
+    def insert_many(self, documents, ordered=True):
+        '''Insert the documents, the duplicates are reported in a
+        BulkWriteError like MongoDB does'''
+        errors = []
+        inserted = []
+        for index, document in enumerate(documents):
+            document.setdefault('_id', ObjectId())
+            key = self._duplicate(document)
+            if key is not None:
+                errors.append({
+                    'index': index, 'code': 11000,
+                    'errmsg': 'E11000 duplicate key error index: ' + key
+                })
+                if ordered:
+                    break
+                continue
+            self._index(document)
+            self._documents[document['_id']] = copy.deepcopy(document)
+            inserted.append(document['_id'])
+        if errors:
+            return self._result(None, BulkWriteError({
+                'writeErrors': errors, 'nInserted': len(inserted)
+            }))
+        return self._result(InsertManyResult(inserted, True))
+
+    def _update_one(self, query, document):
+        '''Apply a $set update or replace the first matching document'''
+        documents = self._find(query)[:1]
+        for stored in documents:
+            self._index(stored, add=False)
+            if '$set' in document:
+                stored.update(copy.deepcopy(document['$set']))
+            else:
+                _id = stored['_id']
+                stored.clear()
+                stored.update(copy.deepcopy(document), _id=_id)
+            self._index(stored)
+        return len(documents)
+
+    def update_one(self, query, document):
+        n = self._update_one(query, document)
+        return self._result(UpdateResult({'n': n, 'nModified': n}, True))
+
+    def replace_one(self, query, document):
+        return self.update_one(query, document)
+
+    def bulk_write(self, requests, ordered=True):
+        '''Run UpdateOne requests'''
+        matched = sum(
+            self._update_one(request._filter, request._doc)
+            for request in requests
+        )
+        return self._result(BulkWriteResult({
+            'nMatched': matched, 'nModified': matched
+        }, True))
+
+    def delete_many(self, query):
+        documents = self._find(query)
+        for document in documents:
+            self._index(document, add=False)
+            del self._documents[document['_id']]
+        return self._result(DeleteResult({'n': len(documents)}, True))
+
+    def with_options(self, **options):
+        '''Read preferences and write concerns change nothing here'''
+        return self
+
+    def create_index(self, keys, unique=False, **kwargs):
+        '''Only unique indexes of a single field change the behaviour'''
+        if unique and isinstance(keys, str) and keys not in self._unique:
+            self._unique[keys] = {
+                document.get(keys) for document in self._documents.values()
+            }
+        return self._result(keys)
+
+
+class Database(object):
+    '''Collections are created on first access, latency is the seconds
+    each operation takes'''
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.operations = 0
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = Collection(self, name)
+        return self._collections[name]
+
+    def command(self, *args, **kwargs):
+        return self['$cmd']._result({'ok': 1})
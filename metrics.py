@@ -0,0 +1,284 @@
+import asyncio
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from pymongo import monitoring
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Histogram(object):
+    '''Counts of observations in fixed buckets'''
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for key, value in labels
+    ) + '}'
+
+
+class Metrics(object):
+    '''Counters, gauges and histograms rendered in the Prometheus text
+    format.
+
+    Labels are tuples of (name, value) pairs, always given in the same
+    order for a metric. Collectors are functions called before rendering,
+    to copy the stats of other objects into gauges.
+    '''
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+        self.histograms = {}
+        self._help = {}
+        self._collectors = []
+        self._db_time = {}
+
+    def describe(self, name, help):
+        self._help[name] = help
+
+    def inc(self, name, value=1, labels=()):
+        self.counters[name, labels] += value
+
+    def set(self, name, value, labels=()):
+        self.gauges[name, labels] = value
+
+    def set_total(self, name, value, labels=()):
+        '''Set a counter from a total kept elsewhere'''
+        self.counters[name, labels] = value
+
+    def add(self, name, value, labels=()):
+        '''Change a gauge by value'''
+        self.gauges[name, labels] += value
+
+    def observe(self, name, value, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[name, labels] = Histogram()
+        histogram.observe(value)
+
+    def add_collector(self, fn):
+        '''Register fn(metrics), called before rendering'''
+        self._collectors.append(fn)
+        return fn
+
+    def track_db_time(self):
+        '''Start adding the database time of the current task'''
+        task = asyncio.current_task()
+        self._db_time[task] = 0.0
+        return task
+
+    def pop_db_time(self, task):
+        '''Stop tracking a task and return its database time'''
+        return self._db_time.pop(task, 0.0)
+
+    def observe_db(self, collection, operation, elapsed, task):
+        self.observe(
+            'mongo_operation_seconds', elapsed,
+            (('collection', collection), ('operation', operation))
+        )
+        if task in self._db_time:
+            self._db_time[task] += elapsed
+
+    def _group(self):
+        '''Samples grouped by metric name'''
+        groups = defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            groups[name, 'counter'].append((labels, value))
+        for (name, labels), value in self.gauges.items():
+            groups[name, 'gauge'].append((labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            groups[name, 'histogram'].append((labels, histogram))
+        return groups
+
+    def render(self):
+        '''The metrics in the Prometheus text format'''
+        for collector in self._collectors:
+            collector(self)
+
+        lines = []
+        for (name, kind), samples in sorted(self._group().items()):
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(samples, key=lambda s: s[0]):
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(labels), value
+                    ))
+                    continue
+
+                cumulative = 0
+                bounds = [str(b) for b in value.buckets] + ['+Inf']
+                for bound, count in zip(bounds, value.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels + (('le', bound),)),
+                        cumulative
+                    ))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), value.sum
+                ))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), value.count
+                ))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class TimedCollection(object):
+    '''A Motor collection that reports the time of its operations'''
+    def __init__(self, collection, metrics):
+        self._collection = collection
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        collection = self._collection.name
+        metrics = self._metrics
+
+        def timed(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # Cursors are returned as they are, operations are awaitables,
+            # run as tasks to time them even when nobody waits for them
+            if inspect.isawaitable(result):
+                task = asyncio.current_task()
+                started = time.perf_counter()
+                result = asyncio.ensure_future(result)
+                result.add_done_callback(lambda future: metrics.observe_db(
+                    collection, name, time.perf_counter() - started, task
+                ))
+            return result
+        return timed
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    '''Time the connection checkouts of the MongoDB pools.
+
+    pymongo calls it from the threads running the operations, so the
+    stats are kept under a lock and copied to metrics before rendering.
+    '''
+    def __init__(self, metrics):
+        self._lock = threading.Lock()
+        self._started = {}
+        self._wait = Histogram()
+        self.stats = {
+            'connections': 0,
+            'checked_out': 0,
+            'failed': defaultdict(int),
+        }
+        metrics.describe(
+            'mongo_pool_wait_seconds',
+            'Time to check out a connection of the MongoDB pool'
+        )
+        metrics.describe(
+            'mongo_pool_checkout_failed_total',
+            'Checkouts failed by reason, like timeout'
+        )
+        metrics.describe('mongo_pool_connections', 'Open pool connections')
+        metrics.describe(
+            'mongo_pool_checked_out', 'Pool connections in use'
+        )
+        metrics.add_collector(self.collect)
+
+    def collect(self, metrics):
+        with self._lock:
+            wait = self._wait.copy()
+            stats = dict(self.stats, failed=dict(self.stats['failed']))
+        metrics.histograms['mongo_pool_wait_seconds', ()] = wait
+        metrics.set('mongo_pool_connections', stats['connections'])
+        metrics.set('mongo_pool_checked_out', stats['checked_out'])
+        for reason, value in stats['failed'].items():
+            metrics.set_total(
+                'mongo_pool_checkout_failed_total', value,
+                (('reason', reason),)
+            )
+
+    def _waited(self):
+        '''The time since this thread started a checkout'''
+        started = self._started.pop(threading.get_ident(), None)
+        if started is None:
+            return None
+        return time.perf_counter() - started
+
+    def connection_check_out_started(self, event):
+        self._started[threading.get_ident()] = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = self._waited()
+        with self._lock:
+            if waited is not None:
+                self._wait.observe(waited)
+            self.stats['checked_out'] += 1
+
+    def connection_check_out_failed(self, event):
+        waited = self._waited()
+        with self._lock:
+            if waited is not None:
+                self._wait.observe(waited)
+            self.stats['failed'][event.reason] += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.stats['checked_out'] -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.stats['connections'] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.stats['connections'] -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+registry = Metrics()
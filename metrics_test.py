@@ -0,0 +1,59 @@
+from metrics import Metrics
+
+
+def test_render_counters_and_gauges():
+    metrics = Metrics()
+    metrics.describe('requests_total', 'Requests served')
+    metrics.inc('requests_total', labels=(('route', '/user/'),))
+    metrics.inc('requests_total', 2, labels=(('route', '/user/'),))
+    metrics.add('connections', 3)
+    metrics.add('connections', -1)
+
+    lines = metrics.render().splitlines()
+
+    assert lines == [
+        '# TYPE connections gauge',
+        'connections 2.0',
+        '# HELP requests_total Requests served',
+        '# TYPE requests_total counter',
+        'requests_total{route="/user/"} 3.0',
+    ]
+
+
+def test_render_histogram():
+    metrics = Metrics()
+    labels = (('route', '/user/'),)
+    for value in (0.0004, 0.003, 0.003, 20):
+        metrics.observe('duration_seconds', value, labels)
+
+    lines = metrics.render().splitlines()
+
+    assert lines[0] == '# TYPE duration_seconds histogram'
+    # Buckets are cumulative, the last one counts every observation
+    assert 'duration_seconds_bucket{route="/user/",le="0.0005"} 1' in lines
+    assert 'duration_seconds_bucket{route="/user/",le="0.0025"} 1' in lines
+    assert 'duration_seconds_bucket{route="/user/",le="0.005"} 3' in lines
+    assert 'duration_seconds_bucket{route="/user/",le="10.0"} 3' in lines
+    assert 'duration_seconds_bucket{route="/user/",le="+Inf"} 4' in lines
+    assert lines[-2] == 'duration_seconds_sum{route="/user/"} 20.0064'
+    assert lines[-1] == 'duration_seconds_count{route="/user/"} 4'
+
+
+def test_label_escaping():
+    metrics = Metrics()
+    metrics.inc('errors_total', labels=(('path', 'a"b\\c\nd'),))
+
+    assert 'errors_total{path="a\\"b\\\\c\\nd"} 1' in metrics.render()
+
+
+def test_collectors():
+    metrics = Metrics()
+    stats = {'hits': 5}
+
+    @metrics.add_collector
+    def collect(metrics):
+        metrics.set_total('cache_hits_total', stats['hits'])
+
+    assert 'cache_hits_total 5' in metrics.render()
+    stats['hits'] = 7
+    assert 'cache_hits_total 7' in metrics.render()
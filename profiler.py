@@ -0,0 +1,160 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+
+class LoopWatchdog(object):
+    '''Report when the event loop is blocked longer than threshold.
+
+    A heartbeat on the loop stores its time every interval seconds, a
+    thread prints the stack of the loop thread when the heartbeat is late,
+    while the blocking call is still running. The heartbeat delays are
+    observed in the loop_lag_seconds histogram of metrics.
+    '''
+    def __init__(self, threshold=0.1, metrics=None, interval=0.05):
+        self.threshold = threshold
+        self.metrics = metrics
+        self.interval = interval
+        self._loop = None
+        self._thread_id = None
+        self._beat = None
+        self._reported = None
+        self._handle = None
+        self._stopped = threading.Event()
+
+    def start(self, loop=None):
+        '''Start watching the loop, call it from the loop thread'''
+        self._loop = loop or asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._handle = self._loop.call_later(self.interval, self._heartbeat)
+        thread = threading.Thread(target=self._watch, name='loop-watchdog')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        if self.metrics is not None:
+            lag = max(now - self._beat - self.interval, 0.0)
+            self.metrics.observe('loop_lag_seconds', lag)
+        self._beat = now
+        self._handle = self._loop.call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == self._reported:
+                continue
+            # Report each block once
+            self._reported = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            print(
+                'Event loop blocked for {:.3f}s, loop thread stack:\n{}'
+                .format(blocked, stack),
+                file=sys.stderr
+            )
+
+
+def collapse(frame):
+    '''The stack of frame as "module:function;...", root first'''
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(
+            os.path.basename(code.co_filename), code.co_name
+        ))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    '''Sample the stack of a thread and count the collapsed stacks, the
+    output is the input of flamegraph.pl'''
+    _lock = threading.Lock()
+
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+
+    def run(self, seconds):
+        '''Sample for seconds, blocking the calling thread. Only one
+        profile runs at a time, returns None when another is running'''
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            samples = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    samples[collapse(frame)] += 1
+                del frame
+                time.sleep(self.interval)
+            return samples
+        finally:
+            self._lock.release()
+
+    async def profile(self, seconds):
+        '''Sample the loop thread from a thread of the default executor'''
+        loop = asyncio.get_running_loop()
+        samples = await loop.run_in_executor(None, self.run, seconds)
+        return samples
+
+
+def format_collapsed(samples):
+    return ''.join(
+        '{} {}\n'.format(stack, count)
+        for stack, count in samples.most_common()
+    )
+
+
+async def profile_view(request, response):
+    '''Profile the loop thread for ?seconds=N (default 10, max 60) and
+    answer the collapsed stacks'''
+    try:
+        seconds = min(float(request.query.get('seconds', ['10'])[-1]), 60)
+    except ValueError:
+        seconds = 10
+
+    samples = await SamplingProfiler().profile(seconds)
+    if samples is None:
+        response.status_code = 409
+        response.set_content('A profile is already running')
+    else:
+        response.set_content(format_collapsed(samples))
+    await response.close()
+
+
+def install_signal_handler(signum=signal.SIGUSR2, seconds=10, directory='.'):
+    '''Profile the loop thread for seconds when signum is received and
+    save the collapsed stacks in profile-<pid>-<time>.txt'''
+    loop = asyncio.get_running_loop()
+
+    async def save_profile():
+        samples = await SamplingProfiler().profile(seconds)
+        if samples is None:
+            return
+        path = os.path.join(directory, 'profile-{}-{}.txt'.format(
+            os.getpid(), int(time.time())
+        ))
+        with open(path, 'w') as output:
+            output.write(format_collapsed(samples))
+        print('Profile saved in {}'.format(path))
+
+    loop.add_signal_handler(
+        signum, lambda: loop.create_task(save_profile())
+    )
@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+
+
+class RateLimit(object):
+    '''Token buckets of rate requests per second and burst requests,
+    one for each client.
+
+    Clients are keyed by the peer address, or by an address of the header
+    when it is given, like X-Forwarded-For behind proxies. Each proxy
+    appends the address it received from, so the client is the one the
+    first of the trusted proxies appended, the proxies from the right:
+    the addresses on the left are sent by the client itself. Buckets
+    are kept in least recently used order: a bucket unused for the time
+    it takes to refill is dropped, as a new one would be the same, and
+    there are never more than max_keys of them.
+    '''
+    def __init__(self, rate, burst=None, header=None, methods=None,
+                 max_keys=100000, proxies=1):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.header = header
+        self.proxies = proxies
+        self.methods = methods
+        self.max_keys = max_keys
+        self.refill_time = self.burst / rate
+        self._buckets = OrderedDict()
+        self.stats = {'allowed': 0, 'limited': 0}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def key(self, request):
+        if self.header is not None:
+            value = request.header.get(self.header)
+            if value:
+                addresses = value.split(',')
+                index = max(len(addresses) - self.proxies, 0)
+                return addresses[index].strip()
+        return request.peer
+
+    def acquire(self, key, now=None):
+        '''Take a token of key, return 0 when there is one or the seconds
+        until the next one'''
+        if now is None:
+            now = time.monotonic()
+        buckets = self._buckets
+        bucket = buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, updated = bucket
+            tokens = min(tokens + (now - updated) * self.rate, self.burst)
+
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+            self.stats['allowed'] += 1
+        else:
+            wait = (1 - tokens) / self.rate
+            self.stats['limited'] += 1
+        buckets[key] = (tokens, now)
+        self._evict(now)
+        return wait
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, (tokens, updated) = next(iter(buckets.items()))
+            if len(buckets) <= self.max_keys and \
+                    now - updated < self.refill_time:
+                break
+            del buckets[key]
+
+    def check(self, request):
+        '''Return 0 when request is allowed or the seconds to retry'''
+        if self.methods is not None and \
+                request.method not in self.methods:
+            return 0
+        return self.acquire(self.key(request))
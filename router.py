@@ -0,0 +1,114 @@
+from collections import OrderedDict
+
+
+class Route(object):
+    '''A registered url and the handler that answers it'''
+    def __init__(self, url, handler, name=None, methods=None, defaults=None,
+                 rate_limit=None, stream_body=False):
+        self.url = url
+        self.handler = handler
+        self.name = name
+        self.methods = methods
+        self.defaults = defaults or {}
+        self.rate_limit = rate_limit
+        # The handler reads the body with request.stream()
+        self.stream_body = stream_body
+
+    def allows(self, method):
+        return self.methods is None or method in self.methods
+
+
+class _Node(object):
+    '''A segment of the dynamic routes trie'''
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_node = None
+        self.route = None
+
+
+class Router(object):
+    '''Match paths against the registered routes.
+
+    Static urls are found with a dict lookup and urls with {placeholders}
+    walking a trie of path segments. The last dynamic matches are kept in
+    a LRU cache of cache_size paths.
+    '''
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._static = {}
+        self._root = _Node()
+        self._cache = OrderedDict()
+
+    def add(self, route):
+        if '{' not in route.url:
+            self._static[route.url] = route
+            return
+
+        node = self._root
+        for segment in route.url.split('/'):
+            if segment.startswith('{') and segment.endswith('}'):
+                name = segment[1:-1]
+                if node.param_node is None:
+                    node.param = name
+                    node.param_node = _Node()
+                elif node.param != name:
+                    raise ValueError('Conflicting placeholder {} in {}'.format(
+                        segment, route.url
+                    ))
+                node = node.param_node
+            elif '{' in segment:
+                raise ValueError(
+                    'Placeholders must be a whole segment: {}'.format(
+                        route.url
+                    )
+                )
+            else:
+                node = node.children.setdefault(segment, _Node())
+        node.route = route
+        self._cache.clear()
+
+    def match(self, path):
+        '''Return (route, kwargs) for the path or None'''
+        path = path.split('?', 1)[0]
+        route = self._static.get(path)
+        if route is not None:
+            return route, route.defaults
+
+        cache = self._cache
+        match = cache.get(path)
+        if match is not None:
+            cache.move_to_end(path)
+            return match
+
+        kwargs = {}
+        route = self._walk(self._root, path.split('/'), 0, kwargs)
+        if route is None:
+            return None
+
+        if route.defaults:
+            kwargs.update(route.defaults)
+        match = (route, kwargs)
+        cache[path] = match
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return match
+
+    def _walk(self, node, segments, index, kwargs):
+        '''Find the route of segments[index:], static segments first'''
+        if index == len(segments):
+            return node.route
+
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            route = self._walk(child, segments, index + 1, kwargs)
+            if route is not None:
+                return route
+
+        if node.param_node is not None and segment:
+            route = self._walk(node.param_node, segments, index + 1, kwargs)
+            if route is not None:
+                kwargs[node.param] = segment
+                return route
+        return None
@@ -1,14 +1,10 @@
-import asyncio
+# Fields of the users never sent to clients, excluded by the queries
+USER_PROJECTION = {'password': 0, 'salt': 0}
 
 
-@asyncio.coroutine
-def user(data):
-    ''' Serialize the data '''
-    del data['password']
-    del data['salt']
-    data['_id'] = str(data['_id'])
-    data['last_login'] = str(data['last_login'])
-    data['created'] = str(data['created'])
-    if data['modified']:
-        data['modified'] = str(data['modified'])
+async def user(data):
+    ''' Serialize the data, the codec encodes the ObjectId and dates.
+    Documents read with USER_PROJECTION have no password already '''
+    data.pop('password', None)
+    data.pop('salt', None)
     return data
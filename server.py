@@ -1,16 +1,24 @@
 import asyncio
-import locale
-import datetime
-from http.server import BaseHTTPRequestHandler
-from io import StringIO
+import math
+import os
+import signal
+import time
+import traceback
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import parse_qs
-import json
-from routes import Mapper
+from codec import default_codec, get_codec
+from compression import (
+    DecompressionLimit, WBITS, decompress, decompress_stream
+)
+from router import Route, Router
 
-locale.setlocale(locale.LC_TIME, 'pt_BR.utf8')
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 STATUS_CODE = {
-    200: '0K',
+    200: 'OK',
     201: 'Created',
     202: 'Accepted',
     203: 'Non-Authoritative Information',
@@ -61,57 +69,517 @@ STATUS_CODE = {
     511: 'Network Authentication Required'
 }
 
+STATUS_LINES = {
+    code: 'HTTP/1.1 {} {}\r\n'.format(code, message).encode('latin-1')
+    for code, message in STATUS_CODE.items()
+}
+
+# Responses without body
+BODYLESS_STATUS = (204, 304)
+
+_date_cache = {'second': None, 'value': None}
+
+
+def http_date(timestamp=None):
+    '''A timestamp in the HTTP format, by default the current one which is
+    formatted once per second'''
+    if timestamp is not None:
+        return formatdate(timestamp, usegmt=True)
+    now = int(time.time())
+    if _date_cache['second'] != now:
+        _date_cache['second'] = now
+        _date_cache['value'] = formatdate(now, usegmt=True)
+    return _date_cache['value']
+
+
+def event_loop_policy(policy='auto'):
+    '''The event loop policy called "asyncio" or "uvloop", "auto" is uvloop
+    when it is installed. Policy objects are returned as they are'''
+    if isinstance(policy, asyncio.AbstractEventLoopPolicy):
+        return policy
+    if policy not in ('auto', 'asyncio', 'uvloop'):
+        raise ValueError('Unknown event loop policy: {}'.format(policy))
+    if policy == 'uvloop' and uvloop is None:
+        raise ValueError('uvloop is not installed')
+    if policy != 'asyncio' and uvloop is not None:
+        return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
+def cancel_tasks(loop):
+    '''Cancel the tasks left, like the handlers of idle connections, and
+    wait for them before closing the loop'''
+    tasks = asyncio.all_tasks(loop)
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+if hasattr(asyncio, 'timeout'):
+    async def with_timeout(coro, timeout):
+        '''Wait for coro at most timeout seconds, None waits forever'''
+        if timeout is None:
+            return await coro
+        # Runs coro in this task, wait_for needs one more task per call
+        async with asyncio.timeout(timeout):
+            return await coro
+else:
+    def with_timeout(coro, timeout):
+        '''Wait for coro at most timeout seconds, None waits forever'''
+        if timeout is None:
+            return coro
+        return asyncio.wait_for(coro, timeout)
+
+
+_HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+_DIGITS = frozenset('0123456789')
+
+
+def _chunk_size(line):
+    '''The size of a chunk-size line, only hex digits are accepted, int()
+    would take signs, 0x and underscores too'''
+    size = line.rstrip(b'\r\n').split(b';', 1)[0].strip(b' \t')
+    if not size or not _HEX_DIGITS.issuperset(size):
+        raise HTTPError(400)
+    return int(size, 16)
+
+
+# Suffixes of the entity tags of compressed responses, longest first
+_CODING_SUFFIXES = tuple(sorted(
+    ('-{}"'.format(coding) for coding in WBITS), key=len, reverse=True
+))
+
+
+def _etag_listed(value, etag, weak=False):
+    '''Check if the comma separated entity tags of a header match etag, a
+    tag of a compressed response matches without its coding suffix'''
+    if value.strip() == '*':
+        return True
+    for tag in value.split(','):
+        tag = tag.strip()
+        for suffix in _CODING_SUFFIXES:
+            if tag.endswith(suffix):
+                tag = tag[:-len(suffix)] + '"'
+                break
+        if weak:
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if etag.startswith('W/'):
+                etag = etag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _coding_etag(value, etag):
+    '''The entity tag of a header listing etag with a coding suffix, the
+    tag of the compressed response the client has, else etag'''
+    for tag in value.split(','):
+        tag = tag.strip()
+        for suffix in _CODING_SUFFIXES:
+            if tag.endswith(suffix) and \
+                    tag[:-len(suffix)] + '"' == etag:
+                return tag
+    return etag
+
+
+class HTTPError(Exception):
+    '''Abort the request answering with status_code'''
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+
+
+class WriteTimeout(ConnectionError):
+    '''The client did not read the response in time'''
+
+
+# Fields that can not be repeated with another value, the body length
+# or the route would depend on which one is read
+_SINGLE_FIELDS = frozenset(('content-length', 'host'))
+
+
+class Headers(object):
+    '''The header fields of a request, names are case-insensitive.
+
+    The raw bytes of the fields are kept and only parsed on the first
+    lookup. A repeated field is joined with commas, as a list of values.
+    '''
+    __slots__ = ('_raw', '_fields')
+
+    def __init__(self, raw=b''):
+        self._raw = raw
+        self._fields = None
+
+    def _parse(self):
+        fields = {}
+        if self._raw:
+            for line in self._raw.decode('latin-1').split('\r\n'):
+                key, sep, value = line.partition(':')
+                # Whitespace around a name could make a proxy read another
+                # field, like "Content-Length :", it is not stripped
+                if not sep or key.split() != [key]:
+                    raise HTTPError(400)
+                key = key.lower()
+                value = value.strip()
+                previous = fields.get(key)
+                if previous is not None and previous != value:
+                    if key in _SINGLE_FIELDS:
+                        raise HTTPError(400)
+                    value = previous + ', ' + value
+                fields[key] = value
+        self._raw = None
+        self._fields = fields
+        return fields
+
+    def get(self, name, default=None):
+        fields = self._fields
+        if fields is None:
+            fields = self._parse()
+        return fields.get(name.lower(), default)
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        fields = self._fields
+        if fields is None:
+            fields = self._parse()
+        return len(fields)
 
-class HTTPRequest(BaseHTTPRequestHandler):
-    def __init__(self, reader):
+    def items(self):
+        fields = self._fields
+        if fields is None:
+            fields = self._parse()
+        return fields.items()
+
+
+_empty_headers = Headers()
+
+
+class HTTPRequest(object):
+    '''A request read from a connection.
+
+    The handler of a connection reuses its request object, reset() makes
+    it ready for the next request, so views must not keep it after the
+    response.
+    '''
+    __slots__ = (
+        'reader', 'peer', 'codec', 'header_timeout', 'body_timeout',
+        'stream_body', 'max_header_size', 'max_body_size', 'method', 'path',
+        'protocol', 'header', 'data', 'route', 'size', 'read_time',
+        'route_time', 'body_pending', '_query', '_buffer',
+    )
+
+    # Largest chunked body buffer kept for the next request
+    buffer_size = 65536
+
+    def __init__(self, reader, max_header_size=8192, max_body_size=1048576,
+                 codec=default_codec, header_timeout=None, body_timeout=None,
+                 peer=None, stream_body=None):
         self.reader = reader
-        self.header = {}
+        self.peer = peer
+        self.codec = codec
+        self.body_timeout = body_timeout
+        # A function of the request that is True when the body is left
+        # in the reader for the view
+        self.stream_body = stream_body
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self._buffer = None
+        self.reset(header_timeout)
+
+    def reset(self, header_timeout=None):
+        '''Forget the last request, the next one has header_timeout
+        seconds to arrive'''
+        self.header_timeout = header_timeout
+        self.method = self.path = self.protocol = None
+        self.header = _empty_headers
         self.data = {}
+        self.route = None
+        self.size = 0
+        self.read_time = self.route_time = 0.0
+        self.body_pending = False
+        self._query = None
 
-    @asyncio.coroutine
-    def process(self):
-        ''' This method will be pparse the request '''
-        if self.header != {}:
+    async def process(self):
+        ''' This method will be parse the request, it returns False when
+        the connection is closed before a new request arrives. Reading the
+        header or the body longer than its timeout raises a 408 error '''
+        if self.method is not None:
             raise Exception('Request is aready processed')
 
-        request_text = b''
-        while True:
-            request_text += yield from self.reader.read(100)
-            self.reader.feed_eof()
-            if self.reader.at_eof():
-                break
+        try:
+            head = await with_timeout(
+                self.reader.readuntil(b'\r\n\r\n'), self.header_timeout
+            )
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HTTPError(400)
+            return False
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431)
+        except asyncio.TimeoutError:
+            raise HTTPError(408)
 
-        yield from self._process_lines(request_text)
-
-    @asyncio.coroutine
-    def _process_lines(self, request_text):
-        '''Convert header data in dict, detect body and call _process_body'''
-        is_header = True
-        body = []
-        for line in request_text.split(b'\n'):
-            if is_header:
-                line = line.strip().replace(b'\r', b'')
-                if line:
-                    yield from self.parse_line(line)
-                else:
-                    is_header = False
-            else:
-                body.append(line)
+        # Time since the header arrived, waiting for it is idle time
+        received_at = time.perf_counter()
+        if len(head) > self.max_header_size:
+            raise HTTPError(431)
+        self._parse_head(head)
+        self.size = len(head)
+
+        if self.stream_body is not None and self.stream_body(self):
+            # The header is parsed before the view, a malformed one or an
+            # ambiguous body length answers 400 like on the other routes
+            self._transfer_encoding()
+            self.body_pending = True
+            self.read_time = time.perf_counter() - received_at
+            return True
+
+        try:
+            body = await with_timeout(
+                self._read_body(), self.body_timeout
+            )
+        except asyncio.TimeoutError:
+            raise HTTPError(408)
+
+        try:
+            await self._process_body(self._decode_body(body))
+        except ValueError:
+            # Invalid compressed data, utf-8 or json
+            raise HTTPError(400)
+        self.size += len(body)
+        self.read_time = time.perf_counter() - received_at
+        return True
+
+    def _parse_head(self, head):
+        '''Parse the request line, the fields are parsed on first use'''
+        end = head.find(b'\r\n')
+        try:
+            method, path, protocol = head[:end].decode('latin-1').split(' ')
+        except ValueError:
+            raise HTTPError(400)
+        if not method.isalpha() or protocol not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise HTTPError(400)
+        self.method = method
+        self.path = path
+        self.protocol = protocol
+        # Without the request line and the blank line
+        self.header = Headers(head[end + 2:-4])
+
+    @property
+    def query(self):
+        '''The query string parameters, parsed on first use, each name has
+        the list of its values'''
+        if self._query is None:
+            _, _, query = self.path.partition('?')
+            self._query = parse_qs(query)
+        return self._query
+
+    def not_modified(self, etag, last_modified=None):
+        '''Check if the client copy is current: If-None-Match lists etag,
+        or without it If-Modified-Since is not older than last_modified,
+        a timestamp'''
+        if_none_match = self.header.get('If-None-Match')
+        if if_none_match is not None:
+            # Weak comparison, W/"x" matches "x"
+            return _etag_listed(if_none_match, etag, weak=True)
+
+        if_modified_since = self.header.get('If-Modified-Since')
+        if if_modified_since is None or last_modified is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have no fraction of second
+        return int(last_modified) <= since
+
+    def if_match(self, etag):
+        '''False when If-Match is given and does not list etag'''
+        if_match = self.header.get('If-Match')
+        return if_match is None or _etag_listed(if_match, etag)
+
+    def _decode_body(self, body):
+        '''Decompress a body sent with Content-Encoding, it is limited to
+        max_body_size bytes too'''
+        encoding = self.header.get('Content-Encoding', 'identity').lower()
+        if encoding == 'identity' or not body:
+            return body
+        if encoding not in WBITS:
+            raise HTTPError(415)
+        try:
+            return decompress(body, encoding, self.max_body_size)
+        except DecompressionLimit:
+            raise HTTPError(413)
+
+    def _transfer_encoding(self):
+        '''The Transfer-Encoding, with a Content-Length too the body length
+        is ambiguous, a proxy could read another request, answer 400'''
+        transfer_encoding = self.header.get('Transfer-Encoding', '').lower()
+        if transfer_encoding and 'Content-Length' in self.header:
+            raise HTTPError(400)
+        return transfer_encoding
+
+    async def _read_body(self):
+        '''Read only this request body, the next pipelined request stays
+        in the reader'''
+        transfer_encoding = self._transfer_encoding()
+        if transfer_encoding == 'chunked':
+            body = await self._read_chunked()
+        elif transfer_encoding:
+            raise HTTPError(501)
+        else:
+            length = self._content_length()
+            body = b''
+            if length:
+                body = await self.reader.readexactly(length)
+        return body
+
+    async def _read_chunked(self):
+        '''Decode a chunked body, in a buffer kept for the next request
+        of the connection when it is small'''
+        body = self._buffer
+        if body is None:
+            body = bytearray()
+        else:
+            del body[:]
+        try:
+            while True:
+                line = await self.reader.readuntil(b'\r\n')
+                size = _chunk_size(line)
+                if size == 0:
+                    break
+                if len(body) + size > self.max_body_size:
+                    raise HTTPError(413)
+                body += await self.reader.readexactly(size)
+                if (await self.reader.readexactly(2)) != b'\r\n':
+                    raise HTTPError(400)
+
+            # Skip the trailer fields
+            while (await self.reader.readuntil(b'\r\n')) != b'\r\n':
+                pass
+        except asyncio.LimitOverrunError:
+            raise HTTPError(400)
+        self._buffer = body if len(body) <= self.buffer_size else None
+        return bytes(body)
+
+    async def _read_stream(self, chunk_size):
+        '''Yield the raw body in pieces, each read waits body_timeout'''
+        transfer_encoding = self._transfer_encoding()
+        reader = self.reader
+        if transfer_encoding == 'chunked':
+            while True:
+                line = await with_timeout(
+                    reader.readuntil(b'\r\n'), self.body_timeout
+                )
+                size = _chunk_size(line)
+                self.size += len(line) + size
+                if size == 0:
+                    break
+                while size:
+                    chunk = await with_timeout(
+                        reader.read(min(size, chunk_size)), self.body_timeout
+                    )
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', size)
+                    size -= len(chunk)
+                    yield chunk
+                if (await reader.readexactly(2)) != b'\r\n':
+                    raise HTTPError(400)
+            while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                pass
+        elif transfer_encoding:
+            raise HTTPError(501)
+        else:
+            length = self._content_length(limited=False)
+            self.size += length
+            while length:
+                chunk = await with_timeout(
+                    reader.read(min(length, chunk_size)), self.body_timeout
+                )
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', length)
+                length -= len(chunk)
+                yield chunk
+
+    async def stream(self, chunk_size=65536):
+        '''Yield the body of a route with stream_body, decompressed, in
+        pieces of at most chunk_size bytes.
+
+        The body has no size limit. Each read waits body_timeout, then a
+        408 error is raised, invalid or truncated bodies raise 400.
+        '''
+        if not self.body_pending:
+            raise Exception('The body is not streamed or already read')
+        encoding = self.header.get('Content-Encoding', 'identity').lower()
+        chunks = self._read_stream(chunk_size)
+        if encoding != 'identity':
+            if encoding not in WBITS:
+                raise HTTPError(415)
+            chunks = decompress_stream(chunks, encoding, chunk_size)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except asyncio.TimeoutError:
+            raise HTTPError(408)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError):
+            raise HTTPError(400)
+        self.body_pending = False
+
+    async def lines(self, max_line_size=None):
+        '''Yield the lines of a streamed body without the line ending,
+        lines longer than max_line_size, max_body_size by default, raise
+        a 413 error'''
+        limit = max_line_size or self.max_body_size
+        buffer = b''
+        async for chunk in self.stream():
+            buffer += chunk
+            start = 0
+            end = buffer.find(b'\n')
+            while end >= 0:
+                yield buffer[start:end]
+                start = end + 1
+                end = buffer.find(b'\n', start)
+            buffer = buffer[start:]
+            if len(buffer) > limit:
+                raise HTTPError(413)
+        if buffer:
+            yield buffer
 
-        yield from self._process_body(b'\n'.join(body).decode())
+    def _content_length(self, limited=True):
+        '''The Content-Length, a limited one over max_body_size raises a
+        413 error. Only digits are accepted, int() would take signs and
+        underscores too'''
+        length = self.header.get('Content-Length', '0')
+        if not length or not _DIGITS.issuperset(length):
+            raise HTTPError(400)
+        length = int(length)
+        if limited and length > self.max_body_size:
+            raise HTTPError(413)
+        return length
 
-    @asyncio.coroutine
-    def _process_json_body(self, body):
-        '''Process json body'''
+    async def _process_json_body(self, body):
+        '''Process json body, decoded from the bytes'''
         if body:
-            data = json.loads(body)
-            for key, value in data.items():
-                self.data[key] = value
+            data = self.codec.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError('The json body is not an object')
+            self.data = data
 
-    @asyncio.coroutine
-    def _process_urlencoded_body(self, body):
+    async def _process_urlencoded_body(self, body):
         '''Process urlencoded body'''
-        data = parse_qs(body)
+        data = parse_qs(body.decode())
 
         for key, value in data.items():
             if '[]' not in key:
@@ -119,39 +587,45 @@ class HTTPRequest(BaseHTTPRequestHandler):
 
             self.data[key] = data[key]
 
-    @asyncio.coroutine
-    def _process_body(self, body):
+    async def _process_body(self, body):
         '''Detect Content-Type and process body'''
-        self.header.setdefault(
+        content_type = self.header.get(
             'Content-Type',
             'application/x-www-form-urlencoded'
         )
-        content_type = self.header['Content-Type']
         if content_type == 'application/x-www-form-urlencoded':
-            yield from self._process_urlencoded_body(body)
+            await self._process_urlencoded_body(body)
         elif 'application/json' in content_type:
-            yield from self._process_json_body(body)
-
-    @asyncio.coroutine
-    def parse_line(self, line):
-        header = self.header
-        if header == {}:
-            data = line.split(b' ')
-            header['METHOD'], header['PATH'], header['PROTOCOL'] = data
-            header['METHOD'] = header['METHOD'].decode()
-            header['PATH'] = header['PATH'].decode()
-            header['PROTOCOL'] = header['PROTOCOL'].decode()
-        else:
-            key, *value = line.split(b':')
-            header[key.decode()] = (b':'.join(value)).strip().decode()
+            await self._process_json_body(body)
 
 
 class HttpResponse(object):
     '''The HTTP Response'''
+    __slots__ = (
+        '_writer', 'codec', 'write_timeout', 'compression', 'accept_encoding',
+        'if_none_match', '_headers', 'keep_alive', 'chunked', 'is_sent',
+        'is_streaming', 'bytes_sent', 'write_time', 'status_code',
+        'status_code_message', '_content',
+    )
+
     def __init__(self, writer, content='',
-                 status_code=200, status_code_message=None):
+                 status_code=200, status_code_message=None,
+                 codec=default_codec, write_timeout=None, compression=None):
         self._writer = writer
+        self.codec = codec
+        self.write_timeout = write_timeout
+        # Compression settings and the coding accepted by the client
+        self.compression = compression
+        self.accept_encoding = None
+        # The entity tags of the request, a 304 sends the one of its coding
+        self.if_none_match = None
         self._headers = {}
+        self.keep_alive = False
+        self.chunked = True
+        self.is_sent = False
+        self.is_streaming = False
+        self.bytes_sent = 0
+        self.write_time = 0.0
         self.status_code = status_code
         self.status_code_message = status_code_message
         self.set_content(content)
@@ -166,11 +640,24 @@ class HttpResponse(object):
             return self.status_code_message
         return STATUS_CODE[self.status_code]
 
+    def get_status_line(self):
+        ''' Get the status line as bytes '''
+        if self.status_code_message is None:
+            status_line = STATUS_LINES.get(self.status_code)
+            if status_line is not None:
+                return status_line
+        return 'HTTP/1.1 {} {}\r\n'.format(
+            self.get_status_code(),
+            self.get_status_message()
+        ).encode('latin-1')
+
     def set_content(self, content):
-        ''' Set the content of response '''
+        ''' Set the content of response, it is stored as bytes '''
         if isinstance(content, dict) or isinstance(content, list):
             self.set_header('Content-Type', 'application/json')
-            content = json.dumps(content)
+            content = self.codec.dumps(content)
+        if not isinstance(content, bytes):
+            content = str(content).encode()
         self._content = content
 
     def get_content(self):
@@ -178,15 +665,14 @@ class HttpResponse(object):
         return self._content
 
     def get_header(self):
-        ''' Get the repsonse header '''
+        ''' Get the response header as bytes, with the ending blank line '''
         self.header_defaults()
-        header = 'HTTP/1.1 {} {}'.format(
-            self.get_status_code(),
-            self.get_status_message()
-        )
-        for key, value in self._headers.items():
-            header += '\n{}: {}'.format(key, value)
-        return header
+        lines = [
+            '{}: {}'.format(key, value)
+            for key, value in self._headers.items()
+        ]
+        lines.append('\r\n')
+        return self.get_status_line() + '\r\n'.join(lines).encode('latin-1')
 
     def set_header(self, key, value):
         '''Set a header'''
@@ -195,122 +681,699 @@ class HttpResponse(object):
     def header_defaults(self):
         self._headers.setdefault('Server', 'Python Asyncio')
         self._headers.setdefault('Content-Type', 'text/plain')
-        self._headers.setdefault(
-            'Date',
-            datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
-        )
-        self._headers.setdefault(
-            'Last-Modified',
-            datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
+        self._headers.setdefault('Date', http_date())
+
+    def get_response_parts(self):
+        '''Get the header and the body to be written'''
+        content = self.get_content()
+        if self.status_code in BODYLESS_STATUS:
+            content = b''
+        else:
+            self.set_header('Content-Length', len(content))
+        self.set_header(
+            'Connection',
+            'keep-alive' if self.keep_alive else 'close'
         )
+        return [self.get_header(), content]
 
     def get_response(self):
         '''Get the response'''
-        return '{}\n\n{}'.format(
-            self.get_header(),
-            self.get_content()
-        ).encode()
+        return b''.join(self.get_response_parts())
+
+    async def write(self, data):
+        '''Stream a piece of the body, the header is sent on the first call.
+
+        HTTP/1.1 clients receive a chunked body, HTTP/1.0 ones a body ended
+        by closing the connection. The content set before is ignored.
+        '''
+        if self.is_sent:
+            raise Exception('Response is already sent')
+        started = time.perf_counter()
+        if not self.is_streaming:
+            self.is_streaming = True
+            if self.chunked:
+                self.set_header('Transfer-Encoding', 'chunked')
+            else:
+                self.keep_alive = False
+            self.set_header(
+                'Connection',
+                'keep-alive' if self.keep_alive else 'close'
+            )
+            header = self.get_header()
+            self._writer.write(header)
+            self.bytes_sent += len(header)
+
+        if not isinstance(data, bytes):
+            data = str(data).encode()
+        if data:
+            # An empty chunk would end the body
+            if self.chunked:
+                size = '{:x}\r\n'.format(len(data)).encode()
+                self._writer.writelines([size, data, b'\r\n'])
+                self.bytes_sent += len(size) + 2
+            else:
+                self._writer.write(data)
+            self.bytes_sent += len(data)
+            await self._drain()
+        self.write_time += time.perf_counter() - started
+
+    async def _compress(self):
+        '''Compress the content with the coding accepted by the client,
+        streamed responses are not compressed'''
+        compression = self.compression
+        headers = self._headers
+        if self.status_code == 304 and self.if_none_match is not None and \
+                'ETag' in headers:
+            headers['ETag'] = _coding_etag(
+                self.if_none_match, headers['ETag']
+            )
+            return
+        if self.status_code in BODYLESS_STATUS or \
+                'Content-Encoding' in headers or \
+                not compression.compressible(
+                    headers.get('Content-Type', 'text/plain')
+                ):
+            return
+        # Caches must tell apart the compressed and identity responses
+        headers['Vary'] = 'Accept-Encoding'
+        content = self._content
+        if self.accept_encoding is None or \
+                len(content) < compression.min_size:
+            return
+        self._content = await compression.compress(
+            content, self.accept_encoding
+        )
+        headers['Content-Encoding'] = self.accept_encoding
+        # The compressed bytes are another representation, with another
+        # strong entity tag
+        etag = headers.get('ETag')
+        if etag is not None and etag.endswith('"'):
+            headers['ETag'] = '{}-{}"'.format(etag[:-1], self.accept_encoding)
+
+    async def _drain(self):
+        '''Wait until the client reads the buffered data, a client slower
+        than write_timeout is disconnected'''
+        if self.write_timeout is None or \
+                not self._writer.transport.get_write_buffer_size():
+            await self._writer.drain()
+            return
+        try:
+            await with_timeout(self._writer.drain(), self.write_timeout)
+        except asyncio.TimeoutError:
+            self._writer.transport.abort()
+            raise WriteTimeout()
 
-    @asyncio.coroutine
-    def close(self):
-        self._writer.write(self.get_response())
-        yield from self._writer.drain()
-        self._writer.close()
+    async def close(self):
+        '''Send the response, the connection is closed unless keep_alive'''
+        if self.is_sent:
+            return
+        self.is_sent = True
+        started = time.perf_counter()
+        if self.is_streaming:
+            if self.chunked:
+                self._writer.write(b'0\r\n\r\n')
+                self.bytes_sent += 5
+        else:
+            if self.compression is not None:
+                await self._compress()
+            parts = self.get_response_parts()
+            self._writer.writelines(parts)
+            self.bytes_sent += len(parts[0]) + len(parts[1])
+        await self._drain()
+        if not self.keep_alive:
+            self._writer.close()
+        self.write_time += time.perf_counter() - started
 
 
 class BaseView(object):
+    http_methods = ('GET', 'POST', 'PUT', 'DELETE')
+    rate_limit = None
+    stream_body = False
+
     def __init__(self, request, response, **kwargs):
         self.request = request
         self.response = response
         self.kwargs = kwargs
 
-    @asyncio.coroutine
-    def _not_alloweded(self):
+    async def _not_alloweded(self):
         self.response.status_code = 405
         self.response.set_content('405')
-        yield from self.response.close()
+        await self.response.close()
 
-    @asyncio.coroutine
-    def get(self):
-        yield from self._not_alloweded()
+    async def get(self):
+        await self._not_alloweded()
 
-    @asyncio.coroutine
-    def post(self):
-        yield from self._not_alloweded()
+    async def post(self):
+        await self._not_alloweded()
 
-    @asyncio.coroutine
-    def put(self):
-        yield from self._not_alloweded()
+    async def put(self):
+        await self._not_alloweded()
 
-    @asyncio.coroutine
-    def delete(self):
-        yield from self._not_alloweded()
+    async def delete(self):
+        await self._not_alloweded()
+
+    @classmethod
+    def allowed_methods(cls):
+        '''The HTTP methods implemented by the view'''
+        return tuple(
+            method for method in cls.http_methods
+            if getattr(cls, method.lower()) is not
+            getattr(BaseView, method.lower())
+        )
 
-    @asyncio.coroutine
-    def handle(self):
-        method = self.request.header['METHOD']
+    async def handle(self):
+        method = self.request.method
         methods = {
             'GET': self.get,
             'POST': self.post,
             'PUT': self.put,
             'DELETE': self.delete
         }
-        yield from methods.get(method, self._not_alloweded)()
+        await methods.get(method, self._not_alloweded)()
 
 
 class App(object):
-    def __init__(self):
+    def __init__(self, keep_alive_timeout=5, max_keep_alive_requests=100,
+                 max_header_size=8192, max_body_size=1048576,
+                 route_cache_size=1024, metrics=None, json_codec=None,
+                 max_connections=None, max_requests_in_flight=None,
+                 header_timeout=10, body_timeout=30, write_timeout=30,
+                 retry_after=1, compression=None):
         self._loop_control = False
-        self._mapper = Mapper()
+        self.codec = get_codec(json_codec)
+        self._router = Router(route_cache_size)
+        self._startup = []
+        self._shutdown = []
+        self._background = []
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.metrics = metrics
+        self._phase_labels = {}
+        # A compression.Compression, None sends identity responses
+        self.compression = compression
 
-    @asyncio.coroutine
-    def reverse_url(self, request):
-        path = request.header['PATH']
-        return self._mapper.match(path)
+        # Admission control, None is unlimited
+        self.max_connections = max_connections
+        self.max_requests_in_flight = max_requests_in_flight
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.write_timeout = write_timeout
+        self.retry_after = retry_after
+        # The handler task of each open connection by its writer
+        self._connections = {}
+        self._requests_in_flight = 0
+        self.stats = {
+            'connections_rejected': 0,
+            'requests_rejected': 0,
+            'read_timeouts': 0,
+            'write_timeouts': 0,
+            'rate_limited': 0,
+        }
+
+        if metrics is not None:
+            self.route('/metrics', methods=('GET',))(self.handle_metrics)
+            self._describe_metrics()
+            metrics.add_collector(self._collect_stats)
+
+    async def reverse_url(self, request):
+        '''Return the (route, kwargs) of the request path or None'''
+        path = request.path
+        return self._router.match(path)
 
-    @asyncio.coroutine
-    def handle_404(self, request, response):
+    async def handle_404(self, request, response):
         response.status_code = 404
         response.set_content('404')
-        yield from response.close()
-
-    @asyncio.coroutine
-    def handle(self, reader, writer):
-        request = HTTPRequest(reader)
-        yield from request.process()
-        response = HttpResponse(writer)
-        reverse = yield from self.reverse_url(request)
+        await response.close()
+
+    async def handle_405(self, request, response, route):
+        response.status_code = 405
+        response.set_header('Allow', ', '.join(route.methods))
+        response.set_content('405')
+        await response.close()
+
+    async def handle_metrics(self, request, response):
+        response.set_header('Content-Type', 'text/plain; version=0.0.4')
+        response.set_content(self.metrics.render())
+        await response.close()
+
+    def _describe_metrics(self):
+        describe = self.metrics.describe
+        describe('http_connections_in_flight', 'Open client connections')
+        describe('http_connections_total', 'Accepted client connections')
+        describe('http_requests_total', 'Requests by route and status')
+        describe('http_errors_total', 'Requests failed by status')
+        describe('http_received_bytes_total', 'Bytes of requests')
+        describe('http_sent_bytes_total', 'Bytes of responses')
+        describe(
+            'http_request_duration_seconds',
+            'Time from the request header to the end of the response'
+        )
+        describe(
+            'http_request_phase_seconds',
+            'Time of each request phase: read the body, route, view, '
+            'database and write the response'
+        )
+        describe('mongo_operation_seconds', 'Time of MongoDB operations')
+        describe('http_requests_in_flight', 'Requests being served')
+        describe(
+            'http_shed_total',
+            'Connections and requests answered 503 over the limits, '
+            'reads answered 408, writes aborted after their timeout and '
+            'requests answered 429 over their rate limit'
+        )
+
+    def _collect_stats(self, metrics):
+        metrics.set('http_requests_in_flight', self._requests_in_flight)
+        for reason, value in self.stats.items():
+            metrics.set_total(
+                'http_shed_total', value, (('reason', reason),)
+            )
+
+    def _record(self, request, response, handled, db_time):
+        '''Add the phases of a request to the metrics'''
+        metrics = self.metrics
+        route = request.route.url if request.route else ''
+        phase_labels = self._phase_labels.get(route)
+        if phase_labels is None:
+            phase_labels = self._phase_labels[route] = {
+                phase: (('route', route), ('phase', phase))
+                for phase in ('read', 'route', 'view', 'db', 'write')
+            }
+
+        read = request.read_time
+        routing = request.route_time
+        write = response.write_time
+        view = max(handled - routing - db_time - write, 0.0)
+        for phase, value in (('read', read), ('route', routing),
+                             ('view', view), ('db', db_time),
+                             ('write', write)):
+            metrics.observe(
+                'http_request_phase_seconds', value, phase_labels[phase]
+            )
+
+        labels = (('route', route), ('status', str(response.status_code)))
+        metrics.observe(
+            'http_request_duration_seconds', read + handled, labels
+        )
+        metrics.inc('http_requests_total', labels=labels)
+        metrics.inc('http_received_bytes_total', request.size)
+        metrics.inc('http_sent_bytes_total', response.bytes_sent)
+
+    async def handle_error(self, request, response, status_code):
+        response.status_code = status_code
+        response.keep_alive = False
+        response.set_content(str(status_code))
+        await response.close()
+
+    async def handle_429(self, request, response, wait):
+        response.status_code = 429
+        response.set_header('Retry-After', str(max(math.ceil(wait), 1)))
+        response.set_content('429')
+        await response.close()
+
+    async def handle_503(self, request, response):
+        response.status_code = 503
+        response.set_header('Retry-After', str(self.retry_after))
+        response.set_content('503')
+        await response.close()
+
+    async def handle_500(self, request, response):
+        traceback.print_exc()
+        response.status_code = 500
+        response.keep_alive = False
+        response.set_content('500')
+        await response.close()
+
+    def keep_alive(self, request):
+        '''HTTP/1.1 connections are persistent unless "Connection: close",
+        HTTP/1.0 ones only with "Connection: keep-alive"'''
+        connection = request.header.get('Connection', '').lower()
+        if request.protocol == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    async def handle(self, reader, writer):
+        '''Serve the requests of a connection in order'''
+        served = 0
+        metrics = self.metrics
+        peer = writer.get_extra_info('peername')
+        if isinstance(peer, tuple):
+            peer = peer[0]
+        self._connections[writer] = asyncio.current_task()
+        if metrics is not None:
+            metrics.inc('http_connections_total')
+            metrics.add('http_connections_in_flight', 1)
+        # The request is reused by the requests of the connection
+        request = HTTPRequest(
+            reader, self.max_header_size, self.max_body_size, self.codec,
+            self.header_timeout, self.body_timeout, peer, self._streams_body
+        )
         try:
-            fn = reverse.pop('_fn')
-        except AttributeError:
-            yield from self.handle_404(request, response)
+            # Over the limit the connection gets a 503 answer as soon as it
+            # is accepted, nothing is read, and is closed
+            if self.max_connections is not None and \
+                    len(self._connections) > self.max_connections:
+                self.stats['connections_rejected'] += 1
+                response = self.create_response(writer)
+                try:
+                    await self.handle_503(request, response)
+                except ConnectionError:
+                    return
+                if metrics is not None:
+                    metrics.inc(
+                        'http_errors_total', labels=(('status', '503'),)
+                    )
+                    metrics.inc('http_sent_bytes_total', response.bytes_sent)
+                return
+
+            while True:
+                # The first request has header_timeout to arrive, then
+                # keep-alive connections are closed when idle
+                if served:
+                    request.reset(self.keep_alive_timeout)
+                try:
+                    has_request = await request.process()
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    if e.status_code == 408:
+                        if served and request.method is None:
+                            break
+                        self.stats['read_timeouts'] += 1
+                    response = self.create_response(writer)
+                    try:
+                        await self.handle_error(
+                            request, response, e.status_code
+                        )
+                    except ConnectionError:
+                        break
+                    if metrics is not None:
+                        metrics.inc(
+                            'http_errors_total',
+                            labels=(('status', str(e.status_code)),)
+                        )
+                        metrics.inc(
+                            'http_sent_bytes_total', response.bytes_sent
+                        )
+                    break
+                if not has_request:
+                    break
+
+                served += 1
+                response = self.create_response(writer, request)
+                response.keep_alive = (
+                    served < self.max_keep_alive_requests and
+                    self.keep_alive(request)
+                )
+                response.chunked = request.protocol != 'HTTP/1.0'
+                admitted = self._admit()
+                if metrics is not None:
+                    task = metrics.track_db_time()
+                if admitted:
+                    self._requests_in_flight += 1
+                started = time.perf_counter()
+                try:
+                    if admitted:
+                        await self.dispatch(request, response)
+                    else:
+                        await self.handle_503(request, response)
+                    # Views that do not close the response still answer
+                    await response.close()
+                except WriteTimeout:
+                    self.stats['write_timeouts'] += 1
+                    break
+                except ConnectionError:
+                    break
+                except HTTPError as e:
+                    # Raised reading a streamed body
+                    if response.is_sent or response.is_streaming:
+                        break
+                    if e.status_code == 408:
+                        self.stats['read_timeouts'] += 1
+                    await self.handle_error(request, response, e.status_code)
+                except Exception:
+                    if response.is_sent or response.is_streaming:
+                        raise
+                    if metrics is not None:
+                        metrics.inc(
+                            'http_errors_total', labels=(('status', '500'),)
+                        )
+                    await self.handle_500(request, response)
+                finally:
+                    if admitted:
+                        self._requests_in_flight -= 1
+                    if metrics is not None:
+                        self._record(
+                            request, response,
+                            time.perf_counter() - started,
+                            metrics.pop_db_time(task)
+                        )
+
+                # The rest of an unread streamed body can not be skipped
+                if not response.keep_alive or request.body_pending:
+                    break
+        finally:
+            writer.close()
+            del self._connections[writer]
+            if metrics is not None:
+                metrics.add('http_connections_in_flight', -1)
+
+    async def close_connections(self):
+        '''Close the open connections and wait for their handlers'''
+        handlers = list(self._connections.values())
+        for writer in list(self._connections):
+            writer.close()
+        if handlers:
+            await asyncio.wait(handlers)
+
+    def create_response(self, writer, request=None):
+        '''A response with the settings of the app, compressed with the
+        coding the request accepts'''
+        response = HttpResponse(
+            writer, codec=self.codec, write_timeout=self.write_timeout,
+            compression=self.compression
+        )
+        if self.compression is not None and request is not None:
+            response.accept_encoding = self.compression.negotiate(
+                request.header.get('Accept-Encoding')
+            )
+            response.if_none_match = request.header.get('If-None-Match')
+        return response
+
+    def _streams_body(self, request):
+        '''True when the route of the request reads the body itself'''
+        match = self._router.match(request.path)
+        return match is not None and match[0].stream_body
+
+    def _admit(self):
+        '''Check the limit of requests in flight before serving a request,
+        counting the requests that are shed'''
+        limit = self.max_requests_in_flight
+        if limit is not None and self._requests_in_flight >= limit:
+            self.stats['requests_rejected'] += 1
+            return False
+        return True
+
+    async def dispatch(self, request, response):
+        started = time.perf_counter()
+        reverse = await self.reverse_url(request)
+        request.route_time = time.perf_counter() - started
+        if reverse is None:
+            await self.handle_404(request, response)
+            return
+
+        route, kwargs = reverse
+        request.route = route
+        if not route.allows(request.method):
+            await self.handle_405(request, response, route)
+            return
+        if route.rate_limit is not None:
+            wait = route.rate_limit.check(request)
+            if wait:
+                self.stats['rate_limited'] += 1
+                await self.handle_429(request, response, wait)
+                return
+
+        fn = route.handler
+        if isinstance(fn, type) and issubclass(fn, BaseView):
+            view = fn(request, response, **kwargs)
+            await view.handle()
         else:
-            if issubclass(fn, BaseView):
-                view = fn(request, response, **reverse)
-                yield from view.handle()
-            else:
-                yield from fn(request, response, **reverse)
+            await fn(request, response, **kwargs)
 
-    def route(self, url, name=None, **kwargs):
+    def route(self, url, name=None, methods=None, rate_limit=None,
+              stream_body=None, **kwargs):
+        '''Register a view or a coroutine for the url.
+
+        The allowed methods of a view are the ones it implements, other
+        handlers accept any method unless methods is given. Requests over
+        rate_limit, a ratelimit.RateLimit, or the rate_limit of the view
+        are answered 429. With stream_body, or the stream_body of the view,
+        the body is not read before calling the handler, it reads it with
+        request.stream() or request.lines().
+        '''
         def decorator(fn):
-            self._mapper.connect(name, url, _fn=fn, **kwargs)
+            allowed = methods
+            limit = rate_limit
+            stream = stream_body
+            if isinstance(fn, type) and issubclass(fn, BaseView):
+                if allowed is None:
+                    allowed = fn.allowed_methods()
+                if limit is None:
+                    limit = fn.rate_limit
+                if stream is None:
+                    stream = fn.stream_body
+            self._router.add(Route(
+                url, fn, name, allowed, kwargs, limit, bool(stream)
+            ))
+            return fn
         return decorator
 
-    def start(self, loop=None, host='127.0.0.1', port=8888):
+    def on_startup(self, fn):
+        '''Register a coroutine function to run before serving requests'''
+        self._startup.append(fn)
+        return fn
+
+    def on_shutdown(self, fn):
+        '''Register a coroutine function to run after serving requests'''
+        self._shutdown.append(fn)
+        return fn
+
+    def on_background(self, fn):
+        '''Register a coroutine function to run while serving requests.
+
+        With several workers only the first one runs it.
+        '''
+        self._background.append(fn)
+        return fn
+
+    def start(self, loop=None, host='127.0.0.1', port=8888, workers=1,
+              loop_policy='auto'):
+        '''Serve requests until Ctrl+C or SIGTERM.
+
+        With more than one worker, the workers are forked processes that
+        accept connections on the same port using SO_REUSEPORT. Without a
+        loop, a loop of loop_policy is created, see event_loop_policy.
+        '''
+        policy = event_loop_policy(loop_policy)
+        if workers > 1:
+            if loop is not None:
+                raise ValueError('Forked workers can not share a loop')
+            self._supervise(host, port, workers, policy)
+        else:
+            self._serve(loop, host, port, policy=policy)
+
+    async def create_server(self, host, port, reuse_port=False):
+        '''Listen on host and port, without running the startup hooks'''
+        options = {'reuse_port': True} if reuse_port else {}
+        server = await asyncio.start_server(
+            self.handle, host, port, limit=self.max_header_size, **options
+        )
+        return server
+
+    def _serve(self, loop, host, port, worker=0, reuse_port=False,
+               policy=None):
+        '''Run the server in this process'''
         if loop is None:
-            loop = asyncio.get_event_loop()
+            loop = (policy or event_loop_policy()).new_event_loop()
+            asyncio.set_event_loop(loop)
             self._loop_control = True
-        coro = asyncio.start_server(self.handle, host, port, loop=loop)
-        server = loop.run_until_complete(coro)
+        for fn in self._startup:
+            loop.run_until_complete(fn())
+        server = loop.run_until_complete(
+            self.create_server(host, port, reuse_port)
+        )
+
+        tasks = []
+        if worker == 0:
+            tasks = [loop.create_task(fn()) for fn in self._background]
 
-        # Serve requests until Ctrl+C is pressed
-        print('Serving on {}'.format(server.sockets[0].getsockname()))
+        # Serve requests until Ctrl+C is pressed or SIGTERM is received
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        print('Serving on {} ({})'.format(
+            server.sockets[0].getsockname(), os.getpid()
+        ))
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
+        loop.remove_signal_handler(signal.SIGTERM)
 
+        for task in tasks:
+            task.cancel()
         server.close()
+        loop.run_until_complete(self.close_connections())
         loop.run_until_complete(server.wait_closed())
+        for fn in self._shutdown:
+            loop.run_until_complete(fn())
         if self._loop_control:
+            cancel_tasks(loop)
             loop.close()
+
+    def _supervise(self, host, port, workers, policy=None):
+        '''Fork the workers, restart the ones that die and forward SIGTERM
+        to stop them and SIGUSR2, like the profiler signal'''
+        children = {}
+        state = {'stopping': False}
+
+        def spawn(index):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+                status = 0
+                try:
+                    self._serve(
+                        None, host, port, index, reuse_port=True,
+                        policy=policy
+                    )
+                except BaseException:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+            children[pid] = (index, time.monotonic())
+
+        def forward(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+        def stop(signum, frame):
+            state['stopping'] = True
+            forward(signal.SIGTERM, frame)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        # Without a handler the signal would stop only the supervisor
+        signal.signal(signal.SIGUSR2, forward)
+        for index in range(workers):
+            spawn(index)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            if pid not in children:
+                continue
+            index, started = children.pop(pid)
+            if state['stopping']:
+                continue
+            print('Worker {} exited with status {}, restarting'.format(
+                pid, status
+            ))
+            # Do not respawn in a tight loop a worker that can not start
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+                # A SIGTERM during the sleep stopped the other workers only
+                if state['stopping']:
+                    continue
+            spawn(index)
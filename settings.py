@@ -1,10 +1,219 @@
 import os
 import motor.motor_asyncio
+from pymongo import ReadPreference, WriteConcern
+import metrics as metrics_module
 
 url = os.environ.get('OPENSHIFT_MONGODB_DB_URL')
 host = os.environ.get('OPENSHIFT_PYTHON_IP', 'localhost')
 port = os.environ.get('OPENSHIFT_PYTHON_PORT', 8000)
 
-print(url)
-client = motor.motor_asyncio.AsyncIOMotorClient(url)
-db = client.register_test
+# Password hashing pool: "process" or "thread"
+hash_executor = os.environ.get('HASH_EXECUTOR', 'process')
+hash_workers = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 1))
+hash_queue_size = int(os.environ.get('HASH_QUEUE_SIZE', 64))
+
+# Persistent connections
+keep_alive_timeout = float(os.environ.get('KEEP_ALIVE_TIMEOUT', 5))
+max_keep_alive_requests = int(os.environ.get('MAX_KEEP_ALIVE_REQUESTS', 100))
+
+# Admission control, 0 is unlimited. Over the limits requests are
+# answered 503 with Retry-After
+max_connections = int(os.environ.get('MAX_CONNECTIONS', 0)) or None
+max_requests_in_flight = int(
+    os.environ.get('MAX_REQUESTS_IN_FLIGHT', 0)
+) or None
+retry_after = int(os.environ.get('RETRY_AFTER', 1))
+
+# Seconds to receive the request header and body, answered 408 after them,
+# and to send the response before dropping the connection
+header_timeout = float(os.environ.get('HEADER_TIMEOUT', 10))
+body_timeout = float(os.environ.get('BODY_TIMEOUT', 30))
+write_timeout = float(os.environ.get('WRITE_TIMEOUT', 30))
+
+# Requests per second and burst of each client on the password hashing
+# routes, over them answered 429, 0 (default) disables the limit
+login_rate = float(os.environ.get('LOGIN_RATE', 0))
+login_burst = int(os.environ.get('LOGIN_BURST', 10))
+signup_rate = float(os.environ.get('SIGNUP_RATE', 0))
+signup_burst = int(os.environ.get('SIGNUP_BURST', 10))
+# Header with the client address, like X-Forwarded-For behind trusted
+# proxies, by default the peer address of the connection is used
+rate_limit_header = os.environ.get('RATE_LIMIT_HEADER') or None
+# Trusted proxies appending to the header, the client address is the one
+# this many entries from the right
+rate_limit_proxies = int(os.environ.get('RATE_LIMIT_PROXIES', 1))
+
+# Request size limits in bytes
+max_header_size = int(os.environ.get('MAX_HEADER_SIZE', 8192))
+max_body_size = int(os.environ.get('MAX_BODY_SIZE', 1048576))
+
+# Cache of user documents
+user_cache_size = int(os.environ.get('USER_CACHE_SIZE', 10000))
+user_cache_ttl = float(os.environ.get('USER_CACHE_TTL', 30))
+
+# Tokens stored in the "db" or HMAC "signed" ones, which need no database
+token_mode = os.environ.get('TOKEN_MODE', 'db')
+if token_mode not in ('db', 'signed'):
+    raise ValueError('TOKEN_MODE must be "db" or "signed"')
+# Without a secret the signed tokens are valid until the server restarts
+token_secret = os.environ.get('TOKEN_SECRET', '').encode() or os.urandom(32)
+# Seconds a token is valid
+token_lifetime = int(os.environ.get('TOKEN_LIFETIME', 10))
+
+# Compress the responses of COMPRESSION_MIN_SIZE bytes or more when the
+# client accepts gzip or deflate
+compression = os.environ.get('COMPRESSION', '').lower() in ('1', 'true', 'yes')
+compression_min_size = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+compression_level = int(os.environ.get('COMPRESSION_LEVEL', 6))
+
+# JSON codec: "orjson", "ujson" or "json", the fastest installed by default
+json_codec = os.environ.get('JSON_CODEC') or None
+
+# Write the last_login of the logins in bulk every milliseconds, or when
+# that many users logged in, 0 writes each login at once
+last_login_flush_ms = float(os.environ.get('LAST_LOGIN_FLUSH_MS', 0))
+last_login_flush_entries = int(
+    os.environ.get('LAST_LOGIN_FLUSH_ENTRIES', 1000)
+)
+
+# Token of the admin routes, /users/ and /users/import/, not served when
+# empty. Users inserted at once by an import and largest page of /users/
+admin_token = os.environ.get('ADMIN_TOKEN', '')
+import_batch_size = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+users_page_size = int(os.environ.get('USERS_PAGE_SIZE', 100))
+
+# Event loop: "uvloop", "asyncio" or "auto", uvloop when installed
+event_loop = os.environ.get('EVENT_LOOP', 'auto')
+
+# Forked server processes, 1 serves in the current process
+workers = int(os.environ.get('WORKERS', 1))
+
+# Serve /metrics and time the MongoDB operations
+metrics = os.environ.get('METRICS', '').lower() in ('1', 'true', 'yes')
+
+# Print the stack when the event loop is blocked longer, 0 disables it
+loop_lag_threshold = float(os.environ.get('LOOP_LAG_THRESHOLD', 0))
+
+# Sampling profiler on /debug/profile/?seconds=N and on SIGUSR2
+profiler = os.environ.get('PROFILER', '').lower() in ('1', 'true', 'yes')
+profile_seconds = float(os.environ.get('PROFILE_SECONDS', 10))
+
+# MongoDB connection pool of each worker, the operations waiting for a
+# connection longer than the wait queue timeout fail, 0 waits until the
+# server selection timeout
+mongo_max_pool_size = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+mongo_min_pool_size = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+mongo_wait_queue_timeout_ms = int(
+    os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 0)
+) or None
+mongo_server_selection_timeout_ms = int(
+    os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000)
+)
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+# Read preference of the profile reads, the secondaries can be behind
+user_read_preference = os.environ.get('USER_READ_PREFERENCE', 'primary')
+if user_read_preference not in READ_PREFERENCES:
+    raise ValueError('USER_READ_PREFERENCE must be one of: {}'.format(
+        ', '.join(READ_PREFERENCES)
+    ))
+# Write concern "w" of the last_login updates, like 0 to not wait for
+# them, empty uses the one of the client
+last_login_write_concern = os.environ.get('LAST_LOGIN_WRITE_CONCERN') or None
+
+
+def parse_write_concern(w):
+    '''A WriteConcern of a "w" value, a number of nodes or a tag name'''
+    return WriteConcern(w=int(w) if w.isdigit() else w)
+
+
+def client_options():
+    '''The options of the MongoDB client of a worker'''
+    options = {
+        'maxPoolSize': mongo_max_pool_size,
+        'minPoolSize': mongo_min_pool_size,
+        'serverSelectionTimeoutMS': mongo_server_selection_timeout_ms,
+    }
+    if mongo_wait_queue_timeout_ms:
+        options['waitQueueTimeoutMS'] = mongo_wait_queue_timeout_ms
+    if metrics:
+        options['event_listeners'] = [pool_listener]
+    return options
+
+
+class LazyDatabase(object):
+    '''A database whose client is created on first use in each process,
+    clients can not be shared by forked workers'''
+    def __init__(self, name):
+        self._name = name
+        self._pid = None
+        self._database = None
+        self._collections = {}
+
+    def get_database(self):
+        if self._pid != os.getpid():
+            client = motor.motor_asyncio.AsyncIOMotorClient(
+                url, **client_options()
+            )
+            self.use(client[self._name])
+        return self._database
+
+    def use(self, database):
+        '''Use another database in this process, like memdb.Database'''
+        self._database = database
+        self._pid = os.getpid()
+        self._collections = {}
+
+    def __getattr__(self, name):
+        database = self.get_database()
+        if not metrics:
+            return getattr(database, name)
+
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = getattr(database, name)
+            if hasattr(collection, 'find_one'):
+                collection = metrics_module.TimedCollection(
+                    collection, metrics_module.registry
+                )
+                self._collections[name] = collection
+        return collection
+
+    def collection(self, name, read_preference=None, write_concern=None):
+        '''The collection name with a read preference of READ_PREFERENCES
+        or a write concern "w" value, None keeps the one of the client'''
+        key = (name, read_preference, write_concern)
+        database = self.get_database()
+        collection = self._collections.get(key)
+        if collection is None:
+            options = {}
+            if read_preference is not None:
+                options['read_preference'] = READ_PREFERENCES[read_preference]
+            if write_concern is not None:
+                options['write_concern'] = parse_write_concern(
+                    write_concern
+                )
+            collection = getattr(database, name)
+            if options:
+                collection = collection.with_options(**options)
+            if metrics:
+                collection = metrics_module.TimedCollection(
+                    collection, metrics_module.registry
+                )
+            self._collections[key] = collection
+        return collection
+
+
+# Connection checkout times of the pools
+pool_listener = None
+if metrics:
+    pool_listener = metrics_module.PoolListener(metrics_module.registry)
+
+db = LazyDatabase('register_test')
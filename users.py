@@ -1,187 +1,655 @@
-from server import App, BaseView
+from server import App, BaseView, HTTPError, STATUS_CODE, http_date
+from cache import AsyncCache
+from compression import Compression
+from executor import ExecutorBusy
+from metrics import registry
+from ratelimit import RateLimit
+from writebehind import WriteBehind
+import profiler
 import utils
 import asyncio
 import os
 import datetime
+import hashlib
+import hmac
+import time
 import serializers
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from settings import db, host, port
+import settings
+
+
+app = App(
+    keep_alive_timeout=settings.keep_alive_timeout,
+    max_keep_alive_requests=settings.max_keep_alive_requests,
+    max_header_size=settings.max_header_size,
+    max_body_size=settings.max_body_size,
+    metrics=registry if settings.metrics else None,
+    json_codec=settings.json_codec,
+    max_connections=settings.max_connections,
+    max_requests_in_flight=settings.max_requests_in_flight,
+    header_timeout=settings.header_timeout,
+    body_timeout=settings.body_timeout,
+    write_timeout=settings.write_timeout,
+    retry_after=settings.retry_after,
+    compression=Compression(
+        settings.compression_min_size, settings.compression_level
+    ) if settings.compression else None
+)
+
+# Users by _id without the USER_PROJECTION fields, the cached documents
+# are shared, copy them before changing
+user_cache = AsyncCache(settings.user_cache_size, settings.user_cache_ttl)
+
+# Buffered last_login updates, written in bulk
+last_login_writer = None
+if settings.last_login_flush_ms:
+    last_login_writer = WriteBehind(
+        db, 'users', settings.last_login_flush_ms / 1000,
+        settings.last_login_flush_entries,
+        write_concern=settings.last_login_write_concern
+    )
+
+
+def client_rate_limit(rate, burst, methods=None):
+    '''A RateLimit of the settings, None when rate is 0'''
+    if not rate:
+        return None
+    return RateLimit(
+        rate, burst, settings.rate_limit_header, methods,
+        proxies=settings.rate_limit_proxies
+    )
+
+
+def now():
+    '''The current time rounded to milliseconds, the precision MongoDB
+    stores, so a cached user has the ETag of the one read back'''
+    current = datetime.datetime.now()
+    return current.replace(microsecond=current.microsecond // 1000 * 1000)
+
+
+def user_validators(user):
+    '''The ETag and the Last-Modified timestamp of a user document, both
+    change when the user is modified or logs in'''
+    changed = max(user['modified'] or user['created'], user['last_login'])
+    version = '{}:{}:{}'.format(
+        user['_id'], user['modified'] or user['created'], user['last_login']
+    )
+    etag = '"{}"'.format(hashlib.sha1(version.encode()).hexdigest()[:20])
+    return etag, changed.timestamp()
+
+
+def set_validators(response, user):
+    etag, last_modified = user_validators(user)
+    response.set_header('ETag', etag)
+    response.set_header('Last-Modified', http_date(last_modified))
+    return etag, last_modified
+
+
+def cache_user(user):
+    '''Cache a copy of the user without the password'''
+    user_cache.set(user['_id'], {
+        key: value for key, value in user.items()
+        if key not in serializers.USER_PROJECTION
+    })
+
+
+def admin_allowed(request):
+    '''True when the request has the ADMIN_TOKEN, compared as bytes, the
+    header is latin-1 and compare_digest takes only ascii strings'''
+    token = request.header.get('token', '').encode('latin-1')
+    return hmac.compare_digest(token, settings.admin_token.encode())
+
+
+def forbidden_response(response):
+    response.status_code = 403
+    response.set_content({'error': 'Forbiden'})
+
+
+def user_error(user):
+    '''The error of the fields of a new user or None'''
+    email = user.get('email')
+    if not isinstance(email, str) or len(email) < 1:
+        return 'email is required'
+    if not isinstance(user.get('password'), str):
+        return 'password is required'
+    return None
+
+
+def busy_response(response):
+    '''The password hashing pool is full, ask the client to retry'''
+    response.status_code = 503
+    response.set_header('Retry-After', str(settings.retry_after))
+    response.set_content({'error': 'Server busy, try again later'})
+
+
+@registry.add_collector
+def collect_stats(metrics):
+    '''Copy the hash pool and the user cache stats to the metrics'''
+    stats = utils.hash_executor.stats
+    metrics.set_total('hash_calls_total', stats['calls'])
+    metrics.set_total('hash_rejected_total', stats['rejected'])
+    metrics.set_total('hash_queue_wait_seconds_total', stats['queue_wait'])
+    metrics.set_total('hash_run_seconds_total', stats['run_time'])
+    metrics.set('hash_pending', utils.hash_executor.pending)
+
+    for key, value in user_cache.stats.items():
+        metrics.set_total('user_cache_{}_total'.format(key), value)
+    metrics.set('user_cache_entries', len(user_cache))
 
-
-app = App()
+    if last_login_writer is not None:
+        for key, value in last_login_writer.stats.items():
+            metrics.set_total('last_login_{}_total'.format(key), value)
+        metrics.set('last_login_pending', len(last_login_writer))
 
 
 @app.route('/login/')
 class LoginView(BaseView):
-    @asyncio.coroutine
-    def post(self):
+    rate_limit = client_rate_limit(settings.login_rate, settings.login_burst)
+
+    async def post(self):
         '''do the login :)'''
         email = self.request.data.get('email')
         password = self.request.data.get('password')
 
-        user = yield from db.users.find_one({
+        user = await db.users.find_one({
             'email': email
         })
 
         if user:
-            password_hash = yield from utils.get_password_hash(
-                user['salt'],
-                password.encode()
-            )
-            if user['password'] == password_hash:
-                user['last_login'] = datetime.datetime.now()
-                yield from db.users.save(user)
+            try:
+                password_hash = await utils.get_password_hash(
+                    user['salt'],
+                    password.encode()
+                )
+            except ExecutorBusy:
+                busy_response(self.response)
+                await self.response.close()
+                return
 
-                user['token'] = yield from utils.generate_token(user)
-                yield from serializers.user(user)
+            if user['password'] == password_hash:
+                user['last_login'] = now()
+                update = {'last_login': user['last_login']}
+                if last_login_writer is not None:
+                    last_login_writer.set(user['_id'], update)
+                else:
+                    users = db.collection(
+                        'users',
+                        write_concern=settings.last_login_write_concern
+                    )
+                    await users.update_one(
+                        {'_id': user['_id']}, {'$set': update}
+                    )
+                cache_user(user)
+
+                user['token'] = await utils.generate_token(user)
+                await serializers.user(user)
                 self.response.set_content(user)
             else:
                 self.invalid_response()
         else:
             self.invalid_response()
-        yield from self.response.close()
+        await self.response.close()
 
     def invalid_response(self):
         self.response.status_code = 401
         self.response.set_content({'error': 'Login invalid'})
 
 
+@app.route('/logout/')
+class LogoutView(BaseView):
+    async def post(self):
+        '''Revoke the token of the request'''
+        token = self.request.header.get('token')
+        if token and await utils.verify_token(token):
+            await utils.revoke_token(token)
+            self.response.status_code = 204
+        else:
+            forbidden_response(self.response)
+        await self.response.close()
+
+
 @app.route('/user/')
 class UserView(BaseView):
-    @asyncio.coroutine
-    def get_user(self, email):
-        ''' Get user by e-mail '''
-        user = yield from db.users.find_one({'email': email})
-        return user
-
-    @asyncio.coroutine
-    def validate_user(self, user):
+    rate_limit = client_rate_limit(
+        settings.signup_rate, settings.signup_burst, ('POST',)
+    )
+
+    async def validate_user(self, user):
         """ Validate user """
-        email = user.get('email')
-        password = user.get('password')
-        has_error = False
-
-        if email is None or len(email) < 1:
-            self.response.set_content({'error': 'email is required'})
-            has_error = True
-        elif password is None or len(password) < 0:
-            self.response.set_content({'error': 'password is required'})
-            has_error = True
-
-        if has_error:
+        error = user_error(user)
+
+        if error is not None:
+            self.response.set_content({'error': error})
             self.response.status_code = 400
-            yield from self.response.close()
+            await self.response.close()
             return False
 
-        _user = yield from self.get_user(email)
-
-        if _user is not None:
-            self.response.set_content({'error': 'User already exists'})
-            yield from self.response.close()
-
         return True
 
-    @asyncio.coroutine
-    def post(self):
+    async def create_user(self, user):
+        ''' Hash the password and insert the user, the unique index of the
+        e-mail rejects an existing user '''
+        user['salt'] = await utils.generate_salt()
+        user['password'] = await utils.get_password_hash(
+            user['salt'], user['password'].encode()
+        )
+        await db.users.insert_one(user)
+
+    async def post(self):
         ''' This method is called on HTTP POST'''
         user = self.request.data
-        is_valid = yield from self.validate_user(user)
+        is_valid = await self.validate_user(user)
 
         if is_valid:
-            user['salt'] = yield from utils.generate_salt()
-            user['last_login'] = user['created'] = datetime.datetime.now()
+            # The _id is known before the insert, the token is stored
+            # while the password is hashed
+            user['_id'] = ObjectId()
+            user['last_login'] = user['created'] = now()
             user['modified'] = None
-            user['password'] = yield from utils.get_password_hash(
-                user['salt'], user['password'].encode()
-            )
-            db.users.insert(user)
-            yield from serializers.user(user)
-
-            # Generate the token
-            user['token'] = yield from utils.generate_token(user)
+            try:
+                _, user['token'] = await asyncio.gather(
+                    self.create_user(user),
+                    utils.generate_token(user, new=True)
+                )
+            except ExecutorBusy:
+                busy_response(self.response)
+                await self.response.close()
+                return
+            except DuplicateKeyError:
+                # The token of the failed insert expires unused
+                self.response.status_code = 409
+                self.response.set_content({'error': 'User already exists'})
+                await self.response.close()
+                return
+
+            await serializers.user(user)
 
             self.response.status_code = 201
             self.response.set_content(user)
-            yield from self.response.close()
+            await self.response.close()
+
+
+class ImportView(BaseView):
+    '''Create the users of a NDJSON body, a user on each line.
+
+    The body is read line by line, the passwords of a batch are hashed in
+    parallel and the batch is inserted while the next one is read, so the
+    memory used does not grow with the body. The result of each line is
+    streamed back as NDJSON, then the totals.
+    '''
+    stream_body = True
+
+    async def post(self):
+        if not admin_allowed(self.request):
+            # The body is not read, the connection can not be reused
+            if self.request.body_pending:
+                self.response.keep_alive = False
+            forbidden_response(self.response)
+            await self.response.close()
+            return
+
+        self.response.set_header('Content-Type', 'application/x-ndjson')
+        self.totals = {'created': 0, 'duplicate': 0, 'invalid': 0, 'error': 0}
+        # Hash as many passwords as the pool has workers, so the import
+        # does not fill the queue of the other requests
+        self.hashing = asyncio.Semaphore(utils.hash_executor.workers)
+        started = time.perf_counter()
+        batch = []
+        inserting = None
+        number = 0
+        error = None
+        try:
+            async for line in self.request.lines():
+                number += 1
+                if line.strip():
+                    batch.append(self.parse(number, line))
+                if len(batch) >= settings.import_batch_size:
+                    inserting = await self.next_batch(batch, inserting)
+                    batch = []
+        except HTTPError as e:
+            if number == 0:
+                raise
+            # The lines read so far are imported, the connection is
+            # closed after the response
+            error = STATUS_CODE[e.status_code]
+            self.response.keep_alive = False
+
+        inserting = await self.next_batch(batch, inserting)
+        await self.write_results(await inserting)
+
+        elapsed = time.perf_counter() - started
+        totals = dict(self.totals, seconds=round(elapsed, 3))
+        totals['users_per_second'] = round(
+            totals['created'] / elapsed if elapsed else 0.0, 1
+        )
+        if error is not None:
+            totals['body_error'] = error
+        await self.write_results([totals])
+        await self.response.close()
+
+    def parse(self, number, line):
+        '''The result of a line and the user to insert, None if invalid'''
+        result = {'line': number}
+        try:
+            user = self.request.codec.loads(line)
+        except ValueError:
+            user = None
+        if not isinstance(user, dict):
+            error = 'invalid json object'
+        else:
+            error = user_error(user)
+        if error is not None:
+            result['status'] = 'invalid'
+            result['error'] = error
+            return result, None
+
+        user['_id'] = result['_id'] = ObjectId()
+        user['last_login'] = user['created'] = now()
+        user['modified'] = None
+        return result, user
+
+    async def hash_password(self, user):
+        user['salt'] = await utils.generate_salt()
+        async with self.hashing:
+            # Wait for a worker instead of failing the line
+            user['password'] = await utils.get_password_hash(
+                user['salt'], user['password'].encode(), reject=False
+            )
+
+    async def next_batch(self, batch, inserting):
+        '''Hash the passwords of batch, send the results of the previous
+        insert and start the insert of batch'''
+        await asyncio.gather(*(
+            self.hash_password(user) for _, user in batch if user
+        ))
+        if inserting is not None:
+            await self.write_results(await inserting)
+        return asyncio.ensure_future(self.insert(batch))
+
+    async def insert(self, batch):
+        '''Insert the users of batch and return the results'''
+        users = [user for _, user in batch if user]
+        errors = {}
+        if users:
+            try:
+                await db.users.insert_many(users, ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details['writeErrors']:
+                    _id = users[write_error['index']]['_id']
+                    errors[_id] = write_error
+        for result, user in batch:
+            if user is None:
+                pass
+            elif user['_id'] not in errors:
+                result['status'] = 'created'
+            elif errors[user['_id']]['code'] == 11000:
+                result['status'] = 'duplicate'
+                del result['_id']
+            else:
+                result['status'] = 'error'
+                result['error'] = errors[user['_id']]['errmsg']
+                del result['_id']
+            self.totals[result['status']] += 1
+        return [result for result, _ in batch]
+
+    async def write_results(self, results):
+        if results:
+            dumps = self.response.codec.dumps
+            await self.response.write(
+                b''.join(dumps(result) + b'\n' for result in results)
+            )
+
+
+class UsersView(BaseView):
+    '''List the users, ?ids=a,b,c gets several users in one query.
+
+    Without ids the users are listed by _id, ?limit=N at a time, and the
+    next page starts ?after= the "next" id of the previous one. The users
+    are written as they come from the cursor.
+    '''
+    # Bytes of users written at once
+    write_size = 16384
+
+    async def get(self):
+        if not admin_allowed(self.request):
+            forbidden_response(self.response)
+            await self.response.close()
+            return
+
+        query = self.request.query
+        page_size = settings.users_page_size
+        try:
+            if 'ids' in query:
+                ids = [
+                    ObjectId(_id) for value in query['ids']
+                    for _id in value.split(',') if _id
+                ]
+                if len(ids) > page_size:
+                    raise ValueError('Too many ids')
+                cursor = db.users.find(
+                    {'_id': {'$in': ids}}, serializers.USER_PROJECTION
+                )
+                limit = None
+            else:
+                limit = int(query.get('limit', [page_size])[-1])
+                if not 0 < limit <= page_size:
+                    raise ValueError('Invalid limit')
+                after = query.get('after')
+                cursor = db.users.find(
+                    {'_id': {'$gt': ObjectId(after[-1])}} if after else {},
+                    serializers.USER_PROJECTION
+                ).sort('_id', 1).limit(limit)
+        except (InvalidId, TypeError, ValueError) as e:
+            self.response.status_code = 400
+            self.response.set_content({'error': str(e)})
+            await self.response.close()
+            return
+
+        await self.write_users(cursor, limit)
+
+    async def write_users(self, cursor, limit):
+        '''Write {"users": [...], "next": id}, with a full page next is
+        the _id of the last user, otherwise null'''
+        response = self.response
+        response.set_header('Content-Type', 'application/json')
+        dumps = response.codec.dumps
+        parts = [b'{"users":[']
+        size = count = 0
+        last = None
+        async for user in cursor:
+            data = dumps(user)
+            parts.append(b',' + data if count else data)
+            size += len(data)
+            count += 1
+            last = user['_id']
+            if size >= self.write_size:
+                await response.write(b''.join(parts))
+                parts = []
+                size = 0
+        parts.append(b']')
+        if limit is not None:
+            parts.append(b',"next":' + dumps(
+                last if count == limit else None
+            ))
+        parts.append(b'}')
+        await response.write(b''.join(parts))
+        await response.close()
 
 
 @app.route('/user/{id}/')
 class UserDetail(BaseView):
-    @asyncio.coroutine
-    def get_token(self):
+    async def get_token(self):
         token = self.request.header.get('token')
         if token is None:
             self.response.status_code = 403
             self.response.set_content({
                 'error': 'Token not found'
             })
-            yield from self.response.close()
+            await self.response.close()
         else:
-            token = yield from db.tokens.find_one({'token': token})
+            token = await utils.verify_token(token)
             if not token:
                 self.response.status_code = 403
                 self.response.set_content({
                     'error': 'Invalid Token'
                 })
-                yield from self.response.close()
+                await self.response.close()
 
         return token
 
-    @asyncio.coroutine
-    def get_user(self):
-        token = yield from self.get_token()
+    async def get_user(self, read_preference=None, cached=True):
+        token = await self.get_token()
         if token:
             _id = ObjectId(self.kwargs['id'])
             if ObjectId(token['user']) == _id:
-                user = yield from db.users.find_one({
-                    '_id': _id
-                })
-                if not user:
+                users = db.collection('users', read_preference)
+
+                def load():
+                    return users.find_one(
+                        {'_id': _id}, serializers.USER_PROJECTION
+                    )
+
+                if cached:
+                    user = await user_cache.get(_id, load)
+                else:
+                    user = await load()
+                if user:
+                    user = dict(user)
+                    if last_login_writer is not None:
+                        # The last_login not written yet, like the cached
+                        # user has
+                        user.update(last_login_writer.get(_id))
+                else:
                     self.response.status_code = 404
                     self.response.set_content({
                         'error': 'User not found'
                     })
-                    yield from self.response.close()
+                    await self.response.close()
                 return user
             else:
                 self.response.status_code = 403
                 self.response.set_content({
                     'error': 'Forbiden'
                 })
-                yield from self.response.close()
+                await self.response.close()
 
-    @asyncio.coroutine
-    def get(self):
-        user = yield from self.get_user()
+    async def get(self):
+        user = await self.get_user(settings.user_read_preference)
 
         if user:
-            yield from serializers.user(user)
-            self.response.set_content(user)
-            yield from self.response.close()
+            etag, last_modified = set_validators(self.response, user)
+            if self.request.not_modified(etag, last_modified):
+                # The client copy is current, skip the serialization
+                self.response.status_code = 304
+            else:
+                await serializers.user(user)
+                self.response.set_content(user)
+            await self.response.close()
 
-    @asyncio.coroutine
-    def put(self):
-        user = yield from self.get_user()
+    async def modified_response(self):
+        self.response.status_code = 412
+        self.response.set_content({
+            'error': 'The user was modified'
+        })
+        await self.response.close()
+
+    async def put(self):
+        # The cache of this process can be stale, If-Match is checked
+        # against the primary
+        user = await self.get_user('primary', cached=False)
 
         if user:
+            etag, _ = user_validators(user)
+            if not self.request.if_match(etag):
+                await self.modified_response()
+                return
+
             data = self.request.data
-            fields_to_remove = ['email', '_id', 'salt']
+            fields_to_remove = [
+                'email', '_id', 'salt', 'created', 'modified', 'last_login'
+            ]
 
             for key in fields_to_remove:
                 if key in data:
                     del data[key]
 
-            user['modified'] = datetime.datetime.now()
+            # Field names of $set can not be operators or nested paths
+            for key in data:
+                if key.startswith('$') or '.' in key:
+                    self.response.status_code = 400
+                    self.response.set_content({
+                        'error': 'Invalid field: {}'.format(key)
+                    })
+                    await self.response.close()
+                    return
+
+            # Only the version read is updated, another update in between
+            # answers 412 instead of being overwritten
+            data['modified'] = now()
+            result = await db.users.update_one(
+                {'_id': user['_id'], 'modified': user['modified']},
+                {'$set': data}
+            )
+            if not result.matched_count:
+                user_cache.invalidate(user['_id'])
+                await self.modified_response()
+                return
             user.update(data)
-            yield from db.users.save(user)
-            yield from serializers.user(user)
+            cache_user(user)
+            set_validators(self.response, user)
+            await serializers.user(user)
             self.response.set_content(user)
-            yield from self.response.close()
+            await self.response.close()
+
+
+async def admin_profile_view(request, response):
+    '''The profiler shows the code of the server, only to the admin'''
+    if not admin_allowed(request):
+        forbidden_response(response)
+        await response.close()
+        return
+    await profiler.profile_view(request, response)
+
+
+if settings.admin_token:
+    app.route('/users/')(UsersView)
+    app.route('/users/import/')(ImportView)
+    if settings.profiler:
+        app.route('/debug/profile/', methods=('GET',))(admin_profile_view)
+
+
+@app.on_startup
+async def start_debug_tools():
+    if settings.loop_lag_threshold:
+        watchdog = profiler.LoopWatchdog(
+            settings.loop_lag_threshold,
+            registry if settings.metrics else None
+        )
+        watchdog.start()
+    if settings.profiler:
+        profiler.install_signal_handler(seconds=settings.profile_seconds)
+
+
+@app.on_shutdown
+async def stop_hash_executor():
+    utils.hash_executor.shutdown()
+
+
+@app.on_shutdown
+async def flush_last_login():
+    if last_login_writer is not None:
+        await last_login_writer.close()
 
-loop = asyncio.get_event_loop()
 
-# start check_token
-loop.call_soon(asyncio.async, utils.check_token())
+# The unique e-mail index must exist before users are created
+app.on_startup(utils.create_indexes)
 
-# start the application
-app.start(loop, host, port)
+if __name__ == '__main__':
+    # start the application
+    app.start(
+        host=host, port=port, workers=settings.workers,
+        loop_policy=settings.event_loop
+    )
@@ -1,8 +1,37 @@
 import requests
 import random
 import pytest
+import socket
 import json
 import time
+import gzip
+import os
+
+
+def raw_request(data, responses=1, timeout=5, segments=()):
+    '''Send raw bytes and read until the number of responses arrive, the
+    segments are sent after the data, each one in a later TCP segment'''
+    sock = socket.create_connection(('localhost', 8888), timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(data)
+    for segment in segments:
+        time.sleep(0.2)
+        sock.sendall(segment)
+    received = b''
+    try:
+        while received.count(b'HTTP/1.') < responses:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+        # Wait to see if the server closes the connection
+        sock.settimeout(0.5)
+        closed = sock.recv(4096) == b''
+    except socket.timeout:
+        closed = False
+    finally:
+        sock.close()
+    return received, closed
 
 
 @pytest.fixture
@@ -42,6 +71,150 @@ def test_user_creation(user):
     assert 'token' in user_created
 
 
+def test_user_creation_chunked(user):
+    body = json.dumps(user).encode()
+    req = requests.post(
+        'http://localhost:8888/user/',
+        # A generator body is sent with Transfer-Encoding: chunked
+        (body[i:i + 16] for i in range(0, len(body), 16)),
+        headers={'Content-Type': 'application/json'}
+    )
+
+    assert req.status_code == 201
+    assert json.loads(req.content.decode())['email'] == user['email']
+
+
+def test_chunk_size_not_hex():
+    for size in (b'-5', b'+5', b'0x5', b'_5'):
+        received, closed = raw_request(
+            b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n' +
+            size + b'\r\n{}\r\n0\r\n\r\n'
+        )
+
+        assert received.startswith(b'HTTP/1.1 400')
+        assert closed
+
+
+def test_chunked_with_content_length():
+    received, closed = raw_request(
+        b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n'
+        b'Content-Type: application/json\r\nContent-Length: 5\r\n'
+        b'Transfer-Encoding: chunked\r\n\r\n2\r\n{}\r\n0\r\n\r\n'
+    )
+
+    # The body length is ambiguous, a request could be smuggled
+    assert received.startswith(b'HTTP/1.1 400')
+    assert closed
+
+
+def test_duplicate_content_length():
+    received, closed = raw_request(
+        b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n'
+        b'Content-Length: 2\r\nContent-Length: 5\r\n\r\n{}'
+    )
+
+    assert received.startswith(b'HTTP/1.1 400')
+    assert closed
+
+
+def test_whitespace_in_field_name():
+    for field in (b'Content-Length : 2', b' Content-Length: 2', b': 2'):
+        received, closed = raw_request(
+            b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n' + field +
+            b'\r\n\r\n{}'
+        )
+
+        assert received.startswith(b'HTTP/1.1 400')
+        assert closed
+
+
+def test_content_length_not_digits():
+    for length in (b'+2', b'1_0', b'0x2', b'-2', b'\xb2'):
+        received, closed = raw_request(
+            b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n'
+            b'Content-Length: ' + length + b'\r\n\r\n{}'
+        )
+
+        assert received.startswith(b'HTTP/1.1 400')
+        assert closed
+
+
+def test_malformed_header_streamed_body():
+    if not os.environ.get('ADMIN_TOKEN'):
+        pytest.skip('ADMIN_TOKEN is not set')
+    received, closed = raw_request(
+        b'POST /users/import/ HTTP/1.1\r\nHost: localhost\r\n'
+        b'no colon\r\nContent-Length: 0\r\n\r\n'
+    )
+
+    assert received.startswith(b'HTTP/1.1 400')
+    assert closed
+
+
+def test_body_in_later_segment(user):
+    body = json.dumps(user).encode()
+    received, closed = raw_request(
+        b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n'
+        b'Content-Type: application/json\r\n'
+        b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n',
+        segments=(body[:10], body[10:])
+    )
+
+    assert received.startswith(b'HTTP/1.1 201')
+    assert user['email'].encode() in received
+    assert not closed
+
+
+def test_header_too_large():
+    received, closed = raw_request(
+        b'GET /user/1/ HTTP/1.1\r\nHost: localhost\r\n'
+        b'X-Padding: ' + b'x' * 70000 + b'\r\n\r\n'
+    )
+
+    assert received.startswith(b'HTTP/1.1 431')
+    assert closed
+
+
+def test_content_length_too_large():
+    received, closed = raw_request(
+        b'POST /user/ HTTP/1.1\r\nHost: localhost\r\n'
+        b'Content-Type: application/json\r\n'
+        b'Content-Length: 1000000000\r\n\r\n{}'
+    )
+
+    # Answered without reading the body
+    assert received.startswith(b'HTTP/1.1 413')
+    assert closed
+
+
+def test_malformed_request_line():
+    lines = (
+        b'GET\r\n', b'GET /user/1/\r\n', b'GET  /user/1/ HTTP/1.1\r\n',
+        b'\x00 /user/1/ HTTP/1.1\r\n', b'GET /user/1/ FOO/1.1\r\n'
+    )
+    for line in lines:
+        received, closed = raw_request(line + b'Host: localhost\r\n\r\n')
+
+        assert received.startswith(b'HTTP/1.1 400')
+        assert closed
+
+
+def test_user_creation_gzip(user):
+    req = requests.post(
+        'http://localhost:8888/user/',
+        gzip.compress(json.dumps(user).encode()),
+        headers={
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }
+    )
+
+    assert req.status_code == 201
+    assert json.loads(req.content.decode())['email'] == user['email']
+
+
 def test_user_validate_email(user):
     del user['email']
 
@@ -66,6 +239,17 @@ def test_user_validate_password(user):
     assert req.status_code == 400
 
 
+def test_user_already_exists(user):
+    for status_code in (201, 409):
+        req = requests.post(
+            'http://localhost:8888/user/',
+            json.dumps(user),
+            headers={'Content-Type': 'application/json'}
+        )
+
+        assert req.status_code == status_code
+
+
 def test_login(user):
     # Create an user
     req_create = requests.post(
@@ -114,6 +298,14 @@ def test_profile(user):
 
     assert req_profile.status_code == 200
 
+    # Header names are case-insensitive
+    req_profile = requests.get(
+        'http://localhost:8888/user/{}/'.format(created['_id']),
+        headers={'TOKEN': created['token']}
+    )
+
+    assert req_profile.status_code == 200
+
 
 def test_profile_blank_token(user):
     # Create an user
@@ -179,3 +371,361 @@ def test_update_profile(user):
     )
 
     assert req_update_profile.status_code == 200
+
+
+def test_profile_tampered_token(user):
+    req_create = requests.post('http://localhost:8888/user/', json=user)
+    token = req_create.json()['token']
+    url = 'http://localhost:8888/user/{}/'.format(req_create.json()['_id'])
+
+    parts = token.split('.')
+    if len(parts) == 3:
+        # A signed token with a later expiry keeps the old signature
+        parts[1] = str(int(parts[1]) + 60000)
+        tampered = '.'.join(parts)
+    else:
+        tampered = token[:-1] + ('0' if token[-1] != '0' else '1')
+    req_profile = requests.get(url, headers={'token': tampered})
+
+    assert req_profile.status_code == 403
+
+
+def test_logout(user):
+    req_create = requests.post('http://localhost:8888/user/', json=user)
+    token = req_create.json()['token']
+    url = 'http://localhost:8888/user/{}/'.format(req_create.json()['_id'])
+
+    req_logout = requests.post(
+        'http://localhost:8888/logout/', headers={'token': token}
+    )
+    assert req_logout.status_code == 204
+
+    # The token is revoked before it expires
+    assert requests.get(url, headers={'token': token}).status_code == 403
+    req_logout = requests.post(
+        'http://localhost:8888/logout/', headers={'token': token}
+    )
+    assert req_logout.status_code == 403
+
+
+def test_login_revokes_token(user):
+    req_create = requests.post('http://localhost:8888/user/', json=user)
+    created = req_create.json()
+    url = 'http://localhost:8888/user/{}/'.format(created['_id'])
+
+    req_login = requests.post('http://localhost:8888/login/', json={
+        'email': user['email'], 'password': user['password']
+    })
+    token = req_login.json()['token']
+
+    assert requests.get(url, headers={'token': token}).status_code == 200
+    req_profile = requests.get(url, headers={'token': created['token']})
+    assert req_profile.status_code == 403
+
+
+def test_profile_not_modified(user):
+    req_create = requests.post(
+        'http://localhost:8888/user/',
+        json.dumps(user),
+        headers={'Content-Type': 'application/json'}
+    )
+    created = json.loads(req_create.content.decode())
+    url = 'http://localhost:8888/user/{}/'.format(created['_id'])
+
+    req_profile = requests.get(url, headers={'token': created['token']})
+    etag = req_profile.headers['ETag']
+    assert req_profile.headers['Last-Modified']
+
+    req_cached = requests.get(url, headers={
+        'token': created['token'],
+        'If-None-Match': etag
+    })
+    assert req_cached.status_code == 304
+    assert req_cached.content == b''
+    assert req_cached.headers['ETag'] == etag
+
+
+def test_compressed_etag(user):
+    if not os.environ.get('COMPRESSION'):
+        pytest.skip('COMPRESSION is not set')
+    created = requests.post('http://localhost:8888/user/', json=user).json()
+    url = 'http://localhost:8888/user/{}/'.format(created['_id'])
+
+    identity = requests.get(url, headers={
+        'token': created['token'], 'Accept-Encoding': 'identity'
+    })
+    min_size = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+    if len(identity.content) < min_size:
+        pytest.skip('The profile is smaller than COMPRESSION_MIN_SIZE')
+    compressed = requests.get(url, headers={
+        'token': created['token'], 'Accept-Encoding': 'gzip'
+    })
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    etag = compressed.headers['ETag']
+    assert etag != identity.headers['ETag']
+
+    # The tag of the compressed response validates the same user
+    req_cached = requests.get(url, headers={
+        'token': created['token'], 'If-None-Match': etag
+    })
+    assert req_cached.status_code == 304
+    req_update = requests.put(url, json={'name': 'José'}, headers={
+        'token': created['token'], 'If-Match': etag
+    })
+    assert req_update.status_code == 200
+
+
+def test_update_profile_if_match(user):
+    req_create = requests.post(
+        'http://localhost:8888/user/',
+        json.dumps(user),
+        headers={'Content-Type': 'application/json'}
+    )
+    created = json.loads(req_create.content.decode())
+    url = 'http://localhost:8888/user/{}/'.format(created['_id'])
+    etag = requests.get(url, headers={'token': created['token']}).headers[
+        'ETag'
+    ]
+
+    req_update = requests.put(url, json={'name': 'José'}, headers={
+        'token': created['token'],
+        'If-Match': etag
+    })
+    assert req_update.status_code == 200
+    assert req_update.headers['ETag'] != etag
+
+    # The etag changed with the update
+    req_stale = requests.put(url, json={'name': 'Maria'}, headers={
+        'token': created['token'],
+        'If-Match': etag
+    })
+    assert req_stale.status_code == 412
+
+
+def test_update_profile_after_login(user):
+    if not os.environ.get('LAST_LOGIN_FLUSH_MS'):
+        pytest.skip('LAST_LOGIN_FLUSH_MS is not set')
+    created = requests.post('http://localhost:8888/user/', json=user).json()
+    url = 'http://localhost:8888/user/{}/'.format(created['_id'])
+    token = requests.post('http://localhost:8888/login/', json={
+        'email': user['email'], 'password': user['password']
+    }).json()['token']
+
+    # The last_login is buffered, the ETag still validates the update
+    etag = requests.get(url, headers={'token': token}).headers['ETag']
+    req_update = requests.put(url, json={'name': 'José'}, headers={
+        'token': token, 'If-Match': etag
+    })
+    assert req_update.status_code == 200
+    req_profile = requests.get(url, headers={'token': token})
+    assert req_profile.headers['ETag'] == req_update.headers['ETag']
+
+
+def test_users_import(user):
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        pytest.skip('ADMIN_TOKEN is not set')
+    other = dict(user, email='other.' + user['email'])
+    lines = [
+        json.dumps(user), '', json.dumps(other), json.dumps(user),
+        '{"email": "maria@silva.org"}', 'not json'
+    ]
+    req = requests.post(
+        'http://localhost:8888/users/import/',
+        # Streamed with Transfer-Encoding: chunked
+        (line.encode() + b'\n' for line in lines),
+        headers={'token': token, 'Content-Type': 'application/x-ndjson'}
+    )
+
+    assert req.status_code == 200
+    results = [json.loads(line) for line in req.text.splitlines()]
+    assert [(result['line'], result['status']) for result in results[:-1]] \
+        == [(1, 'created'), (3, 'created'), (4, 'duplicate'),
+            (5, 'invalid'), (6, 'invalid')]
+    totals = results[-1]
+    assert (totals['created'], totals['duplicate'], totals['invalid']) \
+        == (2, 1, 2)
+
+    # The imported users can login
+    req_login = requests.post('http://localhost:8888/login/', json={
+        'email': other['email'], 'password': other['password']
+    })
+    assert req_login.status_code == 200
+
+
+def test_users_import_forbidden():
+    if not os.environ.get('ADMIN_TOKEN'):
+        pytest.skip('ADMIN_TOKEN is not set')
+    body = b'{"email": "maria@silva.org", "password": "x"}\n'
+    for token in (b'wrong', b'\xe9'):
+        received, closed = raw_request(
+            b'POST /users/import/ HTTP/1.1\r\nHost: localhost\r\n'
+            b'token: ' + token + b'\r\nContent-Length: ' +
+            str(len(body)).encode() + b'\r\n\r\n' + body
+        )
+
+        # The unread body closes the connection
+        assert received.startswith(b'HTTP/1.1 403')
+        assert b'Connection: close' in received
+        assert closed
+
+
+def test_users_list(user):
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        pytest.skip('ADMIN_TOKEN is not set')
+    ids = []
+    for i in range(3):
+        req = requests.post('http://localhost:8888/user/', json=dict(
+            user, email='{}.{}'.format(i, user['email'])
+        ))
+        ids.append(req.json()['_id'])
+
+    req = requests.get(
+        'http://localhost:8888/users/', params={'ids': ','.join(ids)},
+        headers={'token': token}
+    )
+    assert req.status_code == 200
+    users = req.json()['users']
+    assert sorted(found['_id'] for found in users) == sorted(ids)
+    assert 'password' not in users[0] and 'salt' not in users[0]
+
+    # Pages of 2 users after the first one created
+    page = requests.get('http://localhost:8888/users/', params={
+        'after': ids[0], 'limit': 2
+    }, headers={'token': token}).json()
+    assert [found['_id'] for found in page['users']] == ids[1:]
+    assert page['next'] == ids[2]
+    page = requests.get('http://localhost:8888/users/', params={
+        'after': page['next'], 'limit': 2
+    }, headers={'token': token}).json()
+    assert page['next'] is None
+
+    req = requests.get(
+        'http://localhost:8888/users/', params={'after': 'x'},
+        headers={'token': token}
+    )
+    assert req.status_code == 400
+
+
+def test_profile_admin_only():
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token or not os.environ.get('PROFILER'):
+        pytest.skip('ADMIN_TOKEN or PROFILER is not set')
+    url = 'http://localhost:8888/debug/profile/'
+
+    req = requests.get(url, params={'seconds': 0.1})
+    assert req.status_code == 403
+    req = requests.get(url, params={'seconds': 0.1}, headers={'token': token})
+    assert req.status_code == 200
+
+
+def test_metrics():
+    if not os.environ.get('METRICS'):
+        pytest.skip('METRICS is not set')
+    requests.get('http://localhost:8888/user/1/')
+
+    req = requests.get('http://localhost:8888/metrics')
+    assert req.status_code == 200
+    assert req.headers['Content-Type'].startswith('text/plain')
+    lines = req.text.splitlines()
+    assert '# TYPE http_requests_total counter' in lines
+    assert any(
+        line.startswith('http_requests_total{') and 'status="403"' in line
+        for line in lines
+    )
+    assert '# TYPE http_request_duration_seconds histogram' in lines
+    for suffix in ('_bucket{', '_sum{', '_count{'):
+        assert any(
+            line.startswith('http_request_duration_seconds' + suffix)
+            for line in lines
+        )
+    assert any('le="+Inf"' in line for line in lines)
+
+
+def test_keep_alive_pipelining():
+    request = b'GET /user/1/ HTTP/1.1\r\nHost: localhost\r\n\r\n'
+    received, closed = raw_request(request * 2, responses=2)
+
+    # Both pipelined requests are answered on the same connection
+    assert received.count(b'HTTP/1.1 403') == 2
+    assert b'Connection: keep-alive' in received
+    assert not closed
+
+
+def test_connection_close():
+    request = (
+        b'GET /user/1/ HTTP/1.1\r\n'
+        b'Host: localhost\r\n'
+        b'Connection: close\r\n\r\n'
+    )
+    received, closed = raw_request(request)
+
+    assert b'Connection: close' in received
+    assert closed
+
+
+def test_http10_closes_connection():
+    received, closed = raw_request(b'GET /user/1/ HTTP/1.0\r\n\r\n')
+
+    assert received.startswith(b'HTTP/1.1 403')
+    assert closed
+
+
+def test_header_timeout():
+    timeout = float(os.environ.get('HEADER_TIMEOUT', 10))
+    received, closed = raw_request(
+        b'GET /user/1/ HTTP/1.1\r\nHost: localhost\r\n',
+        timeout=timeout + 5
+    )
+
+    assert received.startswith(b'HTTP/1.1 408')
+    assert closed
+
+
+def test_max_connections():
+    limit = int(os.environ.get('MAX_CONNECTIONS', 0))
+    if not limit:
+        pytest.skip('MAX_CONNECTIONS is not set')
+    idle = [
+        socket.create_connection(('localhost', 8888)) for _ in range(limit)
+    ]
+    try:
+        time.sleep(0.5)
+        # Answered before the request is sent
+        received, closed = raw_request(b'')
+    finally:
+        for sock in idle:
+            sock.close()
+
+    assert received.startswith(b'HTTP/1.1 503')
+    assert b'Retry-After: ' in received
+    assert closed
+
+
+def test_method_not_allowed():
+    req = requests.delete('http://localhost:8888/user/')
+
+    assert req.status_code == 405
+    assert req.headers['Allow'] == 'POST'
+
+
+def test_json_body_not_object():
+    req = requests.post('http://localhost:8888/user/', json=['not', 'dict'])
+
+    assert req.status_code == 400
+
+
+def test_login_rate_limit():
+    if not float(os.environ.get('LOGIN_RATE', 0)):
+        pytest.skip('LOGIN_RATE is not set')
+    login = {'email': 'nobody@silva.org', 'password': 'x'}
+    statuses = [
+        requests.post('http://localhost:8888/login/', json=login).status_code
+        for _ in range(20)
+    ]
+
+    assert 429 in statuses
+    req = requests.post('http://localhost:8888/login/', json=login)
+    assert req.status_code == 429
+    assert int(req.headers['Retry-After']) >= 1
@@ -1,46 +1,166 @@
 from settings import db
+from executor import BoundedExecutor
+from expiry import ExpiryHeap
+from pymongo.errors import OperationFailure
+import settings
 import hashlib
+import hmac
+import base64
 import binascii
-import asyncio
 import os
+import time
 import uuid
 import datetime
 
 
-@asyncio.coroutine
-def get_password_hash(salt, password):
+hash_executor = BoundedExecutor(
+    settings.hash_executor,
+    workers=settings.hash_workers,
+    queue_size=settings.hash_queue_size
+)
+
+
+def _pbkdf2(salt, password):
     dk = hashlib.pbkdf2_hmac('sha256', password, salt, 100000)
     return binascii.hexlify(dk)
 
 
-@asyncio.coroutine
-def generate_salt():
+async def get_password_hash(salt, password, reject=True):
+    '''Hash the password in hash_executor, raises ExecutorBusy when full
+    unless reject is False'''
+    password_hash = await hash_executor.run(
+        _pbkdf2, salt, password, reject=reject
+    )
+    return password_hash
+
+
+async def generate_salt():
     return binascii.hexlify(os.urandom(16))
 
 
-@asyncio.coroutine
-def generate_token(user):
+def _signature(payload):
+    digest = hmac.new(settings.token_secret, payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=')
+
+
+def generate_signed_token(user, new=False):
+    '''A token carrying the user id and the expiry in milliseconds, signed
+    with HMAC, the earlier tokens of the user are revoked'''
+    expires = int(time.time() * 1000) + settings.token_lifetime * 1000
+    payload = '{}.{}'.format(user['_id'], expires).encode()
+    if not new:
+        _revoke_signed_tokens(str(user['_id']), expires - 1)
+    return (payload + b'.' + _signature(payload)).decode()
+
+
+# The expiry of the last revoked signed token of each user, the tokens
+# expiring until it are denied, kept until it passes. They are in the
+# memory of each worker, a token is revoked in the worker that served
+# the login or the logout
+_revoked_until = {}
+_revoked_expiry = ExpiryHeap(_revoked_until.pop)
+
+
+def _revoke_signed_tokens(user, expires):
+    if expires > _revoked_until.get(user, 0):
+        _revoked_until[user] = expires
+        _revoked_expiry.schedule(user, expires / 1000 - time.time())
+
+
+def verify_signed_token(token):
+    '''Return {"user": id, "token": token} if the token is valid'''
+    try:
+        payload, signature = token.encode().rsplit(b'.', 1)
+        user, expires = payload.decode().split('.')
+        expires = int(expires)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, _signature(payload)):
+        return None
+    if expires < time.time() * 1000 or \
+            expires <= _revoked_until.get(user, 0):
+        return None
+    return {'user': user, 'token': token}
+
+
+def revoke_signed_token(token):
+    '''Deny a signed token, and the earlier ones of its user, until it
+    expires'''
+    verified = verify_signed_token(token)
+    if verified:
+        expires = int(token.split('.')[1])
+        _revoke_signed_tokens(verified['user'], expires)
+
+
+async def generate_token(user, new=False):
+    '''Issue a token for the user, a new user has no token to remove'''
+    if settings.token_mode == 'signed':
+        return generate_signed_token(user, new)
+
     token = str(uuid.uuid1())
-    # If exists, remove the token from the same user
-    yield from db.tokens.remove({'user': user['_id']})
+    if not new:
+        # If exists, remove the token from the same user
+        await db.tokens.delete_many({'user': user['_id']})
 
-    # Create a token
-    yield from db.tokens.insert({
+    # Create a token, the TTL index compares created_at in UTC
+    await db.tokens.insert_one({
         'user': user['_id'],
         'token': token,
-        'created_at': datetime.datetime.now()
+        'created_at': datetime.datetime.utcnow()
     })
 
     return token
 
 
-@asyncio.coroutine
-def check_token():
-    while True:
-        # Remove invalid expired tokens
-        lt = datetime.datetime.now() - datetime.timedelta(seconds=10)
-        total = yield from db.tokens.find({'created_at': {'$lt': lt}}).count()
-        if total:
-            print('Removing {} tokens'.format(total))
-        yield from db.tokens.remove({'created_at': {'$lt': lt}})
-        yield from asyncio.sleep(1)
+async def verify_token(token):
+    '''Return the token document, with the user id, or None if invalid'''
+    if settings.token_mode == 'signed':
+        return verify_signed_token(token)
+
+    # The TTL monitor removes expired tokens once a minute, ignore them
+    # until it does
+    created_after = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=settings.token_lifetime
+    )
+    token = await db.tokens.find_one({
+        'token': token,
+        'created_at': {'$gt': created_after}
+    })
+    return token
+
+
+async def revoke_token(token):
+    '''Deny the token before it expires, like on logout'''
+    if settings.token_mode == 'signed':
+        revoke_signed_token(token)
+    else:
+        await db.tokens.delete_many({'token': token})
+
+
+async def create_indexes():
+    '''Create the indexes of the queries, an existing index is kept.
+
+    The e-mail is unique, so a concurrent creation of the same user fails
+    with DuplicateKeyError. In db token mode MongoDB removes the tokens
+    token_lifetime seconds after created_at.
+    '''
+    await db.users.create_index('email', unique=True)
+    if settings.token_mode != 'db':
+        return
+
+    await db.tokens.create_index('token')
+    await db.tokens.create_index('user')
+    try:
+        await db.tokens.create_index(
+            'created_at',
+            expireAfterSeconds=settings.token_lifetime
+        )
+    except OperationFailure:
+        # The index exists with another lifetime
+        await db.command(
+            'collMod', 'tokens',
+            index={
+                'keyPattern': {'created_at': 1},
+                'expireAfterSeconds': settings.token_lifetime
+            }
+        )
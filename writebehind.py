@@ -0,0 +1,110 @@
+import asyncio
+import traceback
+from collections import OrderedDict
+
+from pymongo import UpdateOne
+
+
+class WriteBehind(object):
+    '''Buffer $set updates of a collection and write them in bulk.
+
+    The updates of a document are merged by _id, the buffer is written in
+    a single unordered bulk operation every interval seconds, or sooner
+    when it has max_entries documents. Writes run one at a time, so a
+    document is never written with older fields after newer ones. Call
+    close() on shutdown to write what is left.
+
+    The database is a settings.LazyDatabase, the writes use write_concern,
+    a "w" value, or the one of the client.
+    '''
+    def __init__(self, database, collection, interval=0.1, max_entries=1000,
+                 loop=None, write_concern=None):
+        self.database = database
+        self.collection = collection
+        self.write_concern = write_concern
+        self.interval = interval
+        self.max_entries = max_entries
+        self._loop = loop
+        self._pending = OrderedDict()
+        # The updates being written, not in the database yet
+        self._batch = {}
+        self._timer = None
+        self._writing = None
+        self.stats = {'updates': 0, 'merged': 0, 'writes': 0, 'errors': 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def set(self, _id, fields):
+        '''Buffer a $set of fields on the document _id'''
+        self.stats['updates'] += 1
+        pending = self._pending.get(_id)
+        if pending is None:
+            self._pending[_id] = dict(fields)
+        else:
+            self.stats['merged'] += 1
+            pending.update(fields)
+
+        if len(self._pending) >= self.max_entries:
+            self._start_write()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(
+                self.interval, self._start_write
+            )
+
+    def get(self, _id):
+        '''The fields of _id buffered or being written, the document read
+        from the database does not have them yet'''
+        fields = dict(self._batch.get(_id, ()))
+        fields.update(self._pending.get(_id, ()))
+        return fields
+
+    def _start_write(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        if self._writing is not None:
+            # Try again when the running write is done
+            self._timer = self.loop.call_later(
+                self.interval, self._start_write
+            )
+            return
+        batch, self._pending = self._pending, OrderedDict()
+        self._batch = batch
+        self._writing = self.loop.create_task(self._write(batch))
+
+    async def _write(self, batch):
+        collection = self.database.collection(
+            self.collection, write_concern=self.write_concern
+        )
+        requests = [
+            UpdateOne({'_id': _id}, {'$set': fields})
+            for _id, fields in batch.items()
+        ]
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except Exception:
+            # The updates are lost, like a failed write of a request
+            self.stats['errors'] += 1
+            traceback.print_exc()
+        else:
+            self.stats['writes'] += 1
+        finally:
+            self._batch = {}
+            self._writing = None
+
+    async def close(self):
+        '''Write the buffered updates and wait for the writes to finish'''
+        while self._writing is not None or self._pending:
+            if self._writing is not None:
+                await asyncio.wait([self._writing])
+            else:
+                self._start_write()
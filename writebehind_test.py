@@ -0,0 +1,109 @@
+import asyncio
+
+import memdb
+from settings import LazyDatabase
+from writebehind import WriteBehind
+
+
+async def database_with(*ids, latency=0):
+    database = LazyDatabase('test')
+    database.use(memdb.Database(latency))
+    for _id in ids:
+        await database.users.insert_one({'_id': _id, 'x': 0})
+    return database
+
+
+async def find(database, _id):
+    return await database.users.find_one({'_id': _id})
+
+
+def test_merge_by_id():
+    async def run():
+        database = await database_with(1, 2)
+        writer = WriteBehind(database, 'users', interval=10)
+        writer.set(1, {'x': 1})
+        writer.set(1, {'y': 1})
+        writer.set(2, {'x': 2})
+        assert len(writer) == 2
+        await writer.close()
+        return writer, await find(database, 1), await find(database, 2)
+
+    writer, first, second = asyncio.run(run())
+
+    assert (first['x'], first['y'], second['x']) == (1, 1, 2)
+    assert writer.stats == {
+        'updates': 3, 'merged': 1, 'writes': 1, 'errors': 0
+    }
+
+
+def test_write_after_interval():
+    async def run():
+        database = await database_with(1)
+        writer = WriteBehind(database, 'users', interval=0.01)
+        writer.set(1, {'x': 1})
+        assert (await find(database, 1))['x'] == 0
+        await asyncio.sleep(0.05)
+        return writer, await find(database, 1)
+
+    writer, document = asyncio.run(run())
+
+    assert document['x'] == 1
+    assert writer.stats['writes'] == 1
+
+
+def test_write_at_max_entries():
+    async def run():
+        database = await database_with(1, 2)
+        writer = WriteBehind(database, 'users', interval=10, max_entries=2)
+        writer.set(1, {'x': 1})
+        assert writer._writing is None
+        writer.set(2, {'x': 2})
+        # Written without waiting for the interval
+        assert writer._writing is not None and len(writer) == 0
+        await asyncio.sleep(0)
+        return writer, await find(database, 1), await find(database, 2)
+
+    writer, first, second = asyncio.run(run())
+
+    assert (first['x'], second['x']) == (1, 2)
+    assert writer.stats['writes'] == 1
+
+
+def test_one_write_at_a_time():
+    async def run():
+        database = await database_with(1, latency=0.05)
+        writer = WriteBehind(
+            database, 'users', interval=0.01, max_entries=1
+        )
+        writer.set(1, {'x': 1})
+        writing = writer._writing
+        # The next write waits for the running one
+        writer.set(1, {'x': 2})
+        assert writer._writing is writing and len(writer) == 1
+        # Both are visible before they are written
+        assert writer.get(1) == {'x': 2}
+        await asyncio.wait([writing])
+        assert (await find(database, 1))['x'] == 1
+        await writer.close()
+        return writer, await find(database, 1)
+
+    writer, document = asyncio.run(run())
+
+    assert document['x'] == 2
+    assert writer.stats['writes'] == 2
+    assert writer.get(1) == {}
+
+
+def test_close_writes_pending():
+    async def run():
+        database = await database_with(1)
+        writer = WriteBehind(database, 'users', interval=10)
+        writer.set(1, {'x': 1})
+        await writer.close()
+        return writer, await find(database, 1)
+
+    writer, document = asyncio.run(run())
+
+    assert document['x'] == 1
+    assert len(writer) == 0
+    assert writer._timer is None and writer._writing is None